@@ -6,6 +6,7 @@ import bcrypt
 import json
 import traceback
 import sys
+import time
 from whenareyou import whenareyou
 try:
     import queue as Queue
@@ -185,9 +186,12 @@ def get_sessions():
             user_auth = bcrypt.checkpw(password.encode('utf8'), db_hash.encode('utf8'))
             if user_auth:
                 response["data"].update({"sessions":[]})
-                for user_session in sessions:
-                    if sessions[user_session]["username"] == username:
-                        response["data"]["sessions"].append(session)
+                for user_session in sessions.for_user(username):
+                    response["data"]["sessions"].append({
+                        "id": user_session["id"],
+                        "client": user_session["client"],
+                        "created": str(user_session["created"])
+                    })
                 response["type"] = "success"
                 response["text"] = "Fetched active sessions"
             else:
@@ -289,7 +293,7 @@ def end_session():
         # Check for the session id in the core.sessions dictionary
         if session_id in core.sessions.keys():
             log.info(":{0}:Ending session".format(session_id))
-            del core.sessions[session_id]
+            core.end_session(session_id)
             response["type"] = "success"
             response["text"] = "Ended session"
         else:
@@ -333,6 +337,45 @@ def check_session():
         response["data"].update({"valid": False})
     return tools.return_json(response)
 
+@api.route('/get_updates', methods=["GET", "POST"])
+def get_updates():
+    """
+    Poll a sessions updates, for clients that don't use socket.io.
+    Responses to commands that were still processing when /api/command returned are delivered here
+    :param session_id:
+    :param Optional - last_seq: The sequence number of the last update the client received. Updates up to it are
+    acknowledged and dropped, and only newer ones are returned
+    :return: The updates in data, and the sequence number of the newest one
+    """
+    log.info(":API:/api/get_updates")
+    response = {"type": None, "text": None, "data": {}}
+    if request.is_json:
+        request_data = request.get_json()
+    else:
+        request_data = request.form
+    try:
+        session_id = request_data["session_id"]
+        if tools.check_string(session_id) and session_id in core.sessions.keys():
+            core.sessions.touch(session_id)
+            session_updates = core.sessions[session_id]["updates"]
+            try:
+                last_seq = int(request_data.get("last_seq"))
+                core.update_pusher.ack(session_id, last_seq)
+            except (TypeError, ValueError):
+                #Without a sequence number every unacknowledged update is returned
+                last_seq = session_updates.acked
+            response["type"] = "success"
+            response["text"] = "Fetched updates for session {0}".format(session_id)
+            response["data"].update({"updates": session_updates.since(last_seq),
+                                     "last_seq": session_updates.last_seq()})
+        else:
+            response["type"] = "error"
+            response["text"] = "Invalid session id"
+    except KeyError:
+        response["type"] = "error"
+        response["text"] = "Couldn't find session_id in request data"
+    return tools.return_json(response)
+
 @api.route('/respond', methods=["GET", "POST"])
 def command_response():
     """
@@ -356,9 +399,15 @@ def command_response():
                     session_data = core.sessions[session_id]
                     session_commands = session_data["commands"]
                     response_command = None
-                    for command_obj in session_commands:
+                    #Iterate over a copy, commands are appended to the history from other threads
+                    for command_obj in list(session_commands):
                         if command_obj["id"] == command_id:
                             response_command = command_obj
+                    core.sessions.touch(session_id)
+                    if response_command and response_command.get("response_expires", 0) < time.time():
+                        log.info(":{0}:Response listener for command {1} expired".format(session_id, command_id))
+                        response_command.pop("function", None)
+                        response_command.pop("event", None)
                     if response_command:
                         if "function" in response_command.keys() and "event" in response_command.keys():
                             response_function = response_command["function"]
@@ -425,10 +474,13 @@ def process_command():
     Api path for processing a command
     :param command:
     :param session_id:
+    :param Optional - wait: Whether to wait for the response. Defaults to true
+    :param Optional - timeout: Seconds to wait for the response before returning the command id
     :return response object:
     """
     log.info(":API:/api/command")
     response = {"type": None, "data": {}, "text": None}
+    status = 200
     if request.is_json:
         request_data = request.get_json()
     else:
@@ -441,18 +493,35 @@ def process_command():
             # Add the command to the core.sessions command queue
             session_data = core.sessions[session_id]
             log.info(":{1}:Adding command {0} to the command queue".format(command, session_id))
+            core.sessions.touch(session_id)
             command_data = tools.create_command_obj(session_id, command)
-            command_response = core.sessions_monitor.command(
-                command_data, core.sessions[session_id], db, add_to_updates_queue=False
-            )
-            if session_id in core.commands.keys():
-                core.commands[session_id].append(command_data)
+            dispatcher = core.command_dispatcher
+            wait = str(request_data.get("wait", True)).lower() not in ["false", "0", "no"]
+            if wait:
+                try:
+                    timeout = min(float(request_data.get("timeout", dispatcher.timeout)), dispatcher.timeout)
+                except ValueError:
+                    timeout = dispatcher.timeout
             else:
-                core.commands.update({session_id: [command_data]})
-            session_data["commands"].append(command_data)
-            core.commands.update(command_data)
-            log.info(":{0}:Returning command response {1}".format(session_id, tools.fold(str(command_response))))
-            response = command_response
+                timeout = 0
+            try:
+                pending_command = dispatcher.dispatch(command_data, session_data, db)
+                command_response = pending_command.wait(timeout)
+                if command_response:
+                    log.info(":{0}:Returning command response {1}".format(
+                        session_id, tools.fold(str(command_response))))
+                    response = command_response
+                else:
+                    response["type"] = "success"
+                    response["text"] = "Command is processing, the response will be sent to the session updates. " \
+                                       "Poll /api/get_updates for it if you aren't subscribed over socket.io"
+                    response["data"].update({"command_id": command_data["id"], "pending": True})
+            except core.workers.PoolFull:
+                log.warning(":{0}:Command dispatcher is saturated, rejecting command".format(session_id))
+                status = 429
+                response["type"] = "error"
+                response["text"] = "W.I.L.L is busy, please try again in a moment"
+                response["data"].update({"busy": True})
         else:
             log.info(":{0}:Couldn't find session id in sessions".format(session_id))
             response["type"] = "error"
@@ -461,4 +530,4 @@ def process_command():
         log.debug("Couldn't find session id and command in request data")
         response["type"] = "error"
         response["text"] = "Couldn't find session id and command in request data"
-    return tools.return_json(response)
\ No newline at end of file
+    return tools.return_json(response), status
@@ -1,8 +1,8 @@
 #Builtin modules
+import collections
 import logging
 import threading
 import time
-import requests
 
 #Internal modules
 try:
@@ -11,23 +11,43 @@ try:
 except ImportError:
     import plugin_handler
     import parser
-import core.notification as notification
+import core.dispatcher as dispatcher
+import core.lanes as lanes
+import core.scheduler as scheduler
+import core.event_journal as event_journal
+import core.event_actions as event_actions
+import core.session_registry as session_registry
+import core.updates as updates
+import core.metrics as metrics
+import core.tracing as tracing
+import core.workers as workers
+import core.batcher as batcher
+import core.parse_cache as parse_cache
+import core.check_runner as check_runner
+import core.breaker as breaker
 import tools
 
 log = logging.getLogger()
 
-sessions = {}
+sessions = session_registry.SessionRegistry()
 
-events = []
+update_pusher = updates.UpdatePusher(sessions)
 
-processed_commands = 0
+events = scheduler.EventScheduler()
 
-error_num = 0
+journal = None
 
-success_num = 0
+event_executor = None
+
+commands_processed = metrics.counter(
+    "will_commands_total", "Commands processed, by response type", ["result"])
 
 commands = {}
 
+configuration_data = {}
+
+command_dispatcher = None
+
 class sessions_monitor():
     @staticmethod
     def command(command_data, session,  db, add_to_updates_queue=True):
@@ -38,39 +58,55 @@ class sessions_monitor():
         :param session:
         :param db:
         :param add_to_updates_queue:
-        :return: response object
+        :return: Task that finishes with the response object once the plugin answers
         """
-        global processed_commands
-        global error_num
-        global success_num
-        processed_commands+=1
-        # Call the parser
-        command_data.update({"db": db})
-        parse_data = parser.parse(command_data, session)
         command_id = command_data['id']
+        trace = tracing.Trace(command_id, command_data["command"])
+        # Call the parser
+        command_data.update({"db": db, "trace": trace})
+        phrase, phrase_plugin = plugin_handler.match_phrase(command_data["command"])
+        if phrase_plugin:
+            log.info(":{0}:Command matched phrase {1}, skipping the parser".format(command_id, phrase))
+            parse_data = parser.phrase_event(command_data, session, phrase)
+        else:
+            with trace.span("parse"):
+                parse_data = parser.parse(command_data, session)
         parse_data.update({"command_id": command_data['id']})
         log.info(":{0}:Finished parsing".format(command_id))
-        response = plugin_handler.subscriptions().process_event(parse_data, db)
-        log.info("Got response {0} with type {1}".format(response, type(response)))
-        if response["type"] == "success":
-            success_num+=1
-        else:
-            error_num+=1
-        log.debug("Got response {0} from plugin handler".format(response))
-        log.info("{0}:Setting update for command with response {1}".format(
-            command_id, response
-        ))
-        session_id = session['id']
-        #Add the response to the update queue
-        global sessions
-        if add_to_updates_queue:
-            sessions[session_id]["updates"].put({"command_id": command_id, "response": response})
-        if session_id in commands.keys():
-            commands[session_id].append([command_data["command"], response["text"]])
-        else:
-            commands.update({session_id:
-                             [[command_data["command"], response["text"]]]})
-        return response
+        response_task = plugin_handler.subscriptions().process_event(parse_data, db, phrase_plugin)
+        command_task = workers.Task()
+        def finish(finished_task):
+            '''Record and deliver the response once the plugin answers'''
+            try:
+                try:
+                    response = finished_task.result(0)
+                finally:
+                    #Close the trace whether the plugin answered or failed
+                    trace.finish()
+                if configuration_data.get("debug") and response:
+                    response = dict(response)
+                    response["data"] = dict(response["data"] or {}, timings=trace.timings())
+                log.info("Got response {0} with type {1}".format(response, type(response)))
+                commands_processed.inc(result="success" if response["type"] == "success" else "error")
+                log.debug("Got response {0} from plugin handler".format(response))
+                log.info("{0}:Setting update for command with response {1}".format(
+                    command_id, response
+                ))
+                session_id = session['id']
+                #Add the response to the update queue
+                if add_to_updates_queue:
+                    update_pusher.push(session_id, {"command_id": command_id, "response": response})
+                if session_id in sessions:
+                    history_size = configuration_data.get("session_history", session_registry.default_history)
+                    session_history = commands.setdefault(session_id, collections.deque(maxlen=history_size))
+                    session_history.append([command_data["command"], response["text"]])
+            except Exception as command_exception:
+                log.exception(":{0}:Error finishing command".format(command_id))
+                command_task.set_exception(command_exception)
+                return
+            command_task.set_result(response)
+        response_task.add_done_callback(finish)
+        return command_task
 
     @staticmethod
     def update_sessions(username, update_data):
@@ -81,46 +117,22 @@ class sessions_monitor():
         Puts data into the update queue for the user so the client can serve it to them
 
         """
-        active_sessions = [i for i in sessions if sessions[i]["username"] == username]
-        map(lambda s: sessions[s]["updates"].put(update_data), active_sessions)
+        for session_id in sessions.session_ids(username):
+            update_pusher.push(session_id, update_data)
 
     def monitor(self, db):
         """
         :param db:
 
-        Thread that continuously handles passive events, like event triggers
+        Thread that continuously handles passive events, like event triggers.
+        It only decides what's due, the actions run on the event executor
 
         """
-        global events
         while True:
-            time.sleep(0.1)
-            if events:
-                for event in events:
-                    current_time = time.time()
-                    if event["time"] <= current_time:
-                        log.debug("Processing event {0}".format(event))
-                        event_type = event["type"]
-                        if event_type == "notification":
-                            username = event["username"]
-                            #Active sessions for the user
-                            sessions_monitor.update_sessions(username, event)
-                            update_data = {"type": "notification", "text": event["value"], "data": event}
-                            sessions_monitor.update_sessions(username, update_data)
-                            notification_thread = threading.Thread(
-                                  target=notification.send_notification, args=(event, db))
-                            notification_thread.start()
-                        elif event_type == "url":
-                            response = requests.get(event["value"]).text
-                            update_data = {"type": "event", "text": response, "data": event}
-                            username = event["username"]
-                            sessions_monitor.update_sessions(username, update_data)
-                        elif event_type == "function":
-                            response = event["value"]()
-                            update_data = {"type": "event", "text": response, "data": event}
-                            username = event["username"]
-                            sessions_monitor.update_sessions(username, update_data)
-                        events.remove(event)
-
+            #Sleep until the next event is due or an earlier one is inserted
+            event = events.wait_next()
+            log.debug("Processing event {0}".format(event))
+            event_executor.fire(event)
 
     def __init__(self, db):
         """
@@ -128,18 +140,126 @@ class sessions_monitor():
 
         :param db:
         """
+        global journal
+        global event_executor
         #Pull pending notifications
         db.query('delete from `events` where time <= {0}'.format(time.time()))
+        pending = {}
         for i in db['events'].all():
-            events.append(i)
+            pending.update({i["uid"]: i})
+        #Apply anything that was journaled but not yet compacted into the db
+        journal = event_journal.EventJournal(
+            path=configuration_data.get("event_journal", event_journal.default_path),
+            commit_interval=configuration_data.get("journal_commit_interval", event_journal.default_commit_interval),
+            compact_interval=configuration_data.get("journal_compact_interval", event_journal.default_compact_interval)
+        )
+        journal.replay(pending)
+        current_time = time.time()
+        for event in pending.values():
+            if event["time"] > current_time:
+                events.insert(event, record=False)
+        events.journal = journal
+        journal.start(lambda: list(events), db)
+        #Write the recovered events back to the db and start a fresh journal
+        journal.compact()
+        event_executor = event_actions.EventExecutor(
+            db, sessions_monitor.update_sessions, events.insert,
+            limits=configuration_data.get("event_workers"),
+            queue_depth=configuration_data.get("event_queue_depth", event_actions.default_queue_depth),
+            timeouts=configuration_data.get("event_timeouts")
+        )
         sessions_thread = threading.Thread(target=self.monitor, args=(db,))
         sessions_thread.start()
 
+def queued_updates():
+    """
+    :return number of updates buffered across all sessions:
+    """
+    return sum(session_data["updates"].qsize() for session_data in list(sessions.values()))
+
+metrics.gauge("will_active_sessions", "Active sessions", function=sessions.session_count)
+metrics.gauge("will_active_users", "Users with at least one active session", function=sessions.user_count)
+metrics.gauge("will_update_queue_depth", "Updates buffered across all sessions", function=queued_updates)
+metrics.gauge("will_command_queue_depth", "Commands waiting for a dispatcher worker",
+              function=lambda: command_dispatcher.pool.queued() if command_dispatcher else 0)
+
+def end_session(session_id):
+    """
+    Remove a session and its command history
+
+    :param session_id:
+    :return the removed session, or None if it wasn't active:
+    """
+    commands.pop(session_id, None)
+    return sessions.remove(session_id)
+
 def initialize(db):
     """
-    Run the plugin loader
+    Start the parser, run the plugin loader, and start the command dispatcher, session reaper, and update pusher
 
     :param db:
     """
+    global command_dispatcher
+    parser.set_models(
+        model=configuration_data.get("parse_model", parser.default_model),
+        full_model=configuration_data.get("full_model")
+    )
+    #Fork the parser processes before any threads are started
+    if configuration_data.get("parse_processes"):
+        log.info("Starting parser processes")
+        parser.start_process_pool(
+            processes=configuration_data["parse_processes"],
+            timeout=configuration_data.get("parse_timeout", parser.default_pool_timeout)
+        )
+    elif configuration_data.get("parse_batching", True):
+        log.info("Starting parse batcher")
+        parser.start_batcher(
+            window=configuration_data.get("parse_batch_window", batcher.default_window),
+            batch_size=configuration_data.get("parse_batch_size", batcher.default_batch_size)
+        )
+    if configuration_data.get("parse_cache", True):
+        parser.start_cache(
+            max_entries=configuration_data.get("parse_cache_entries", parse_cache.default_max_entries),
+            max_bytes=configuration_data.get("parse_cache_bytes", parse_cache.default_max_bytes)
+        )
+    if configuration_data.get("lazy_parse", True):
+        parser.start_lazy_parsing()
     log.info("Loading plugins")
-    plugin_handler.load("core/plugins", db)
\ No newline at end of file
+    plugin_handler.load("core/plugins", db)
+    #Check functions run under the routing deadline, so the full model can't be loaded inside one
+    if any(plugin.get("check_needs") or plugin.get("prepare") for plugin in plugin_handler.plugin_subscriptions):
+        log.info("Loading the full model for the check functions that need it")
+        parser.full_model()
+        plugin_handler.prepare_plugins(parser.parse_full)
+    log.info("Starting plugin lanes")
+    plugin_handler.start_lanes(
+        lane_workers=configuration_data.get("plugin_lanes"),
+        queue_depth=configuration_data.get("plugin_lane_queue_depth", lanes.default_queue_depth),
+        user_depth=configuration_data.get("plugin_lane_user_depth", lanes.default_user_depth),
+        timeout=configuration_data.get("plugin_timeout", plugin_handler.default_plugin_timeout),
+        failure_threshold=configuration_data.get("breaker_failures", breaker.default_failure_threshold),
+        reset_seconds=configuration_data.get("breaker_reset_seconds", breaker.default_reset_seconds)
+    )
+    log.info("Starting check runner")
+    plugin_handler.start_check_runner(
+        worker_num=configuration_data.get("check_workers", check_runner.default_workers),
+        queue_depth=configuration_data.get("check_queue_depth", check_runner.default_queue_depth),
+        timeout=configuration_data.get("check_timeout", check_runner.default_timeout),
+        demote_after=configuration_data.get("check_demote_after", check_runner.default_demote_after),
+        demote_seconds=configuration_data.get("check_demote_seconds", check_runner.default_demote_seconds)
+    )
+    log.info("Starting command dispatcher")
+    command_dispatcher = dispatcher.CommandDispatcher(
+        sessions_monitor.command, update_pusher.push,
+        worker_num=configuration_data.get("command_workers", dispatcher.default_workers),
+        queue_depth=configuration_data.get("command_queue_depth", dispatcher.default_queue_depth),
+        timeout=configuration_data.get("command_timeout", dispatcher.default_timeout)
+    )
+    log.info("Starting session reaper")
+    session_registry.SessionReaper(
+        sessions, end_session,
+        idle_ttl=configuration_data.get("session_idle_ttl", session_registry.default_idle_ttl),
+        max_age=configuration_data.get("session_max_age", session_registry.default_max_age)
+    ).start()
+    log.info("Starting update pusher")
+    update_pusher.start()
\ No newline at end of file
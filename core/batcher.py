@@ -0,0 +1,105 @@
+#Builtin imports
+import logging
+import threading
+import time
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+#Internal imports
+import core.metrics as metrics
+import core.workers as workers
+
+log = logging.getLogger()
+
+#Seconds to wait for more commands after the first one of a batch arrives
+default_window = 0.003
+
+#The most commands run through the pipeline at once
+default_batch_size = 32
+
+batch_sizes = metrics.histogram(
+    "will_parse_batch_size", "Number of commands parsed in each batch", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+
+class ParseBatcher:
+    '''
+    Collects commands that arrive close together and runs them through a pipe function in one batch,
+    so concurrent commands share the per call overhead of the pipeline instead of contending for it
+    '''
+    def __init__(self, pipe_function, window=default_window, batch_size=default_batch_size):
+        """
+        :param pipe_function: Called as pipe_function(texts, batch_size=batch_size), returning one result per text
+        :param window: Seconds to wait for more commands after the first one of a batch arrives
+        :param batch_size: The most commands in a batch
+        """
+        self.pipe_function = pipe_function
+        self.window = window
+        self.batch_size = batch_size
+        self._queue = Queue.Queue()
+
+    def submit(self, text):
+        """
+        Queue a text for the next batch
+
+        :param text:
+        :return Task that's given the parsed text:
+        """
+        task = workers.Task()
+        self._queue.put((text, task))
+        return task
+
+    def parse(self, text):
+        """
+        Parse a text in the next batch and wait for the result
+
+        :param text:
+        :return the parsed text:
+        """
+        return self.submit(text).result()
+
+    def _collect(self):
+        """
+        Wait for a command, then gather any others that arrive within the window
+
+        :return list of (text, task):
+        """
+        batch = [self._queue.get()]
+        deadline = time.time()+self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline-time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run_batch(self, batch):
+        """
+        :param batch: list of (text, task)
+        """
+        batch_sizes.observe(len(batch))
+        texts = [text for text, task in batch]
+        try:
+            results = list(self.pipe_function(texts, batch_size=self.batch_size))
+        except Exception as batch_exception:
+            log.exception("Error parsing a batch of {0} commands".format(len(batch)))
+            for text, task in batch:
+                task.set_exception(batch_exception)
+            return
+        for (text, task), result in zip(batch, results):
+            task.set_result(result)
+
+    def _batch_loop(self):
+        '''Batching thread'''
+        while True:
+            self._run_batch(self._collect())
+
+    def start(self):
+        '''Start the batching thread'''
+        batch_thread = threading.Thread(target=self._batch_loop, name="parse-batcher")
+        batch_thread.daemon = True
+        batch_thread.start()
@@ -0,0 +1,160 @@
+#Builtin imports
+import logging
+import threading
+import time
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+#Errors or timeouts in a row that open a breaker
+default_failure_threshold = 5
+
+#Seconds a breaker stays open before it lets a trial call through
+default_reset_seconds = 60
+
+closed = "closed"
+open_state = "open"
+half_open = "half_open"
+
+breaker_trips = metrics.counter("will_breaker_trips_total", "Times a plugins circuit breaker opened", ["plugin"])
+
+
+class CircuitBreaker:
+    '''
+    Stops calling a plugin after it fails too many times in a row.
+    After reset_seconds one trial call is let through, and the breaker closes again if it succeeds
+    '''
+    def __init__(self, name, failure_threshold=default_failure_threshold, reset_seconds=default_reset_seconds):
+        """
+        :param name: The plugin name
+        :param failure_threshold: Failures in a row that open the breaker
+        :param reset_seconds: Seconds the breaker stays open
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.state = closed
+        self.failures = 0
+        self.opened_at = None
+        self.last_failure = None
+
+    def allow(self):
+        """
+        :return boolean, whether the plugin can be called:
+        """
+        with self._lock:
+            if self.state == closed:
+                return True
+            if self.state == open_state and time.time()-self.opened_at >= self.reset_seconds:
+                log.info("Letting a trial call through the circuit breaker of plugin {0}".format(self.name))
+                self.state = half_open
+                return True
+            #Open, or half open with the trial call still running
+            return False
+
+    def start_call(self):
+        """
+        :return a token for one call, so only its first outcome is recorded:
+        """
+        return {"settled": False}
+
+    def _settle(self, call):
+        """
+        Mark a call as recorded. Needs the lock
+
+        :param call: Token from start_call, or None for an outcome that isn't tied to a call
+        :return boolean, whether the outcome should be recorded:
+        """
+        if call is None:
+            return True
+        if call["settled"]:
+            return False
+        call["settled"] = True
+        return True
+
+    def record_success(self, call=None):
+        """
+        :param call: Token from start_call. A call that was already charged with a timeout doesn't close the breaker
+        when it finishes late
+        """
+        with self._lock:
+            if not self._settle(call):
+                return
+            if self.state != closed:
+                log.info("Closing the circuit breaker of plugin {0}".format(self.name))
+            self.state = closed
+            self.failures = 0
+
+    def record_failure(self, reason, call=None):
+        """
+        :param reason: Description of the error or timeout
+        :param call: Token from start_call. A call is only charged once, whether it times out or fails first
+        """
+        with self._lock:
+            if not self._settle(call):
+                return
+            self.failures += 1
+            self.last_failure = reason
+            if self.state == half_open or (self.state == closed and self.failures >= self.failure_threshold):
+                self.state = open_state
+                self.opened_at = time.time()
+                tripped = True
+            else:
+                tripped = False
+        if tripped:
+            log.warning("Opening the circuit breaker of plugin {0} after {1} failures, last was {2}".format(
+                self.name, self.failures, reason
+            ))
+            breaker_trips.inc(plugin=self.name)
+
+    def to_dict(self):
+        """
+        :return json serializable dictionary of the breaker state:
+        """
+        with self._lock:
+            return {
+                "plugin": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "last_failure": self.last_failure,
+                "retry_in": round(max(self.opened_at+self.reset_seconds-time.time(), 0), 3)
+                if self.state == open_state else None
+            }
+
+
+class BreakerRegistry:
+    '''
+    A circuit breaker for each plugin, created the first time it's called
+    '''
+    def __init__(self, failure_threshold=default_failure_threshold, reset_seconds=default_reset_seconds):
+        """
+        :param failure_threshold:
+        :param reset_seconds:
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, name):
+        """
+        :param name: The plugin name
+        :return CircuitBreaker:
+        """
+        with self._lock:
+            plugin_breaker = self._breakers.get(name)
+            if plugin_breaker is None:
+                plugin_breaker = CircuitBreaker(name, self.failure_threshold, self.reset_seconds)
+                self._breakers[name] = plugin_breaker
+            return plugin_breaker
+
+    def states(self):
+        """
+        :return list of breaker dictionaries, sorted by plugin name:
+        """
+        with self._lock:
+            breakers = sorted(self._breakers.values(), key=lambda plugin_breaker: plugin_breaker.name)
+        return [plugin_breaker.to_dict() for plugin_breaker in breakers]
@@ -0,0 +1,145 @@
+#Builtin imports
+import logging
+import threading
+import time
+
+#Internal imports
+import core.metrics as metrics
+import core.workers as workers
+
+log = logging.getLogger()
+
+default_workers = 16
+
+default_queue_depth = 256
+
+#Seconds every check of a command has to finish in
+default_timeout = 0.5
+
+#Timeouts in a row before a check is demoted
+default_demote_after = 3
+
+#Seconds a demoted check is skipped for
+default_demote_seconds = 300
+
+check_timeouts = metrics.counter(
+    "will_check_timeouts_total", "Check functions that didn't finish before the routing deadline", ["plugin"])
+
+check_demotions = metrics.counter(
+    "will_check_demotions_total", "Times a check function was demoted for timing out repeatedly", ["plugin"])
+
+checks_skipped = metrics.counter(
+    "will_checks_skipped_total", "Check functions skipped because they were demoted", ["plugin"])
+
+
+class CheckRunner:
+    '''
+    Runs the check functions of a command concurrently on a shared pool, with one deadline for all of them.
+    A check that misses the deadline counts as not matching, and a check that keeps missing it is skipped for a while
+    '''
+    def __init__(self, worker_num=default_workers, queue_depth=default_queue_depth, timeout=default_timeout,
+                 demote_after=default_demote_after, demote_seconds=default_demote_seconds):
+        """
+        :param worker_num:
+        :param queue_depth:
+        :param timeout: Seconds the checks of a command have to finish in
+        :param demote_after: Timeouts in a row before a check is demoted
+        :param demote_seconds: Seconds a demoted check is skipped for
+        """
+        self.pool = workers.WorkerPool("plugin-checks", worker_num, queue_depth)
+        self.timeout = timeout
+        self.demote_after = demote_after
+        self.demote_seconds = demote_seconds
+        self._lock = threading.Lock()
+        #Plugin name -> timeouts in a row
+        self._strikes = {}
+        #Plugin name -> time the demotion ends
+        self._demoted = {}
+
+    def is_demoted(self, plugin_name):
+        """
+        :param plugin_name:
+        :return boolean:
+        """
+        with self._lock:
+            demoted_until = self._demoted.get(plugin_name)
+            if demoted_until is None:
+                return False
+            if demoted_until > time.time():
+                return True
+            #Let it back in on probation, one more timeout demotes it again
+            del self._demoted[plugin_name]
+            self._strikes[plugin_name] = self.demote_after-1
+            return False
+
+    def record(self, plugin_name, timed_out):
+        """
+        :param plugin_name:
+        :param timed_out: Whether the check missed the deadline
+        """
+        with self._lock:
+            if not timed_out:
+                self._strikes.pop(plugin_name, None)
+                return
+            strikes = self._strikes.get(plugin_name, 0)+1
+            self._strikes[plugin_name] = strikes
+            if strikes < self.demote_after:
+                return
+            self._demoted[plugin_name] = time.time()+self.demote_seconds
+        log.warning("Demoting the check function of plugin {0} for {1} seconds after {2} timeouts".format(
+            plugin_name, self.demote_seconds, strikes
+        ))
+        check_demotions.inc(plugin=plugin_name)
+
+    def demoted(self):
+        """
+        :return plugin name -> seconds left of its demotion:
+        """
+        now = time.time()
+        with self._lock:
+            return dict((plugin_name, round(demoted_until-now, 3))
+                        for plugin_name, demoted_until in self._demoted.items() if demoted_until > now)
+
+    def run(self, plugins, check):
+        """
+        Run check(plugin) for each plugin that isn't demoted
+
+        :param plugins: Plugin subscriptions
+        :param check: Called with a subscription, returns whether it matches
+        :return list of the subscriptions that matched, in order:
+        """
+        deadline = time.time()+self.timeout
+        tasks = []
+        for plugin in plugins:
+            if self.is_demoted(plugin["name"]):
+                checks_skipped.inc(plugin=plugin["name"])
+                continue
+            try:
+                task = self.pool.submit(check, plugin)
+            except workers.PoolFull:
+                log.warning("Check pool is saturated, running the check of plugin {0} inline".format(plugin["name"]))
+                task = workers.Task()
+                try:
+                    task.set_result(check(plugin))
+                except Exception as check_exception:
+                    task.set_exception(check_exception)
+            tasks.append((plugin, task))
+        matched = []
+        for plugin, task in tasks:
+            try:
+                result = task.result(max(deadline-time.time(), 0))
+            except workers.TaskTimeout:
+                log.warning("Check function of plugin {0} missed the {1} second routing deadline".format(
+                    plugin["name"], self.timeout
+                ))
+                check_timeouts.inc(plugin=plugin["name"])
+                self.record(plugin["name"], True)
+                continue
+            except Exception:
+                log.exception("Check function of plugin {0} raised an exception".format(plugin["name"]))
+                self.record(plugin["name"], False)
+                continue
+            self.record(plugin["name"], False)
+            if result:
+                matched.append(plugin)
+        return matched
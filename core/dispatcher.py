@@ -0,0 +1,118 @@
+#Builtin imports
+import logging
+
+#Internal imports
+import core.workers as workers
+
+log = logging.getLogger()
+
+default_workers = 8
+
+default_queue_depth = 32
+
+default_timeout = 30
+
+
+class PendingCommand:
+    '''
+    A command that has been handed to the dispatcher but might not have a response yet
+    '''
+    def __init__(self, command_id, session, task, update_function):
+        self.command_id = command_id
+        self.session = session
+        self.task = task
+        self.update_function = update_function
+
+    def _deliver(self, task):
+        """
+        Done callback that puts a detached commands response in the session update queue
+
+        :param task:
+        """
+        response = self._task_response(task)
+        log.info(":{0}:Delivering detached command response to session updates".format(self.command_id))
+        self.update_function(self.session["id"], {"command_id": self.command_id, "response": response})
+
+    def _task_response(self, task):
+        """
+        Get the response out of a finished task, turning an exception into an error response
+
+        :param task:
+        :return response object:
+        """
+        try:
+            return task.result(0)
+        except Exception as command_exception:
+            log.error(":{0}:Command raised {1}".format(self.command_id, repr(command_exception)))
+            return {"type": "error", "text": "An error occurred while processing the command", "data": {}}
+
+    def detach(self):
+        '''Stop waiting, and send the response to the session updates when it's ready'''
+        self.task.add_done_callback(self._deliver)
+
+    def wait(self, timeout):
+        """
+        Wait for the response. If it doesn't come within the timeout, detach the command
+
+        :param timeout: Seconds to wait. 0 detaches immediately
+        :return response object, or None if the command was detached:
+        """
+        if timeout:
+            try:
+                return self.task.result(timeout)
+            except workers.TaskTimeout:
+                pass
+            except Exception:
+                return self._task_response(self.task)
+        log.info(":{0}:Detaching command after waiting {1} seconds".format(self.command_id, timeout))
+        self.detach()
+        return None
+
+
+class CommandDispatcher:
+    '''
+    Parses and routes commands on a bounded worker pool so a slow plugin doesn't hold a request thread.
+    The command function can return a Task, in which case the worker moves on and the command is answered
+    when the Task finishes
+    '''
+    def __init__(self, command_function, update_function, worker_num=default_workers,
+                 queue_depth=default_queue_depth, timeout=default_timeout):
+        """
+        :param command_function: Called as command_function(command_data, session, db, add_to_updates_queue=False),
+        returns a response object or a Task that finishes with one
+        :param update_function: Called as update_function(session_id, update_data) to deliver detached responses
+        :param worker_num:
+        :param queue_depth:
+        :param timeout: The longest a caller is allowed to wait on a command
+        """
+        self.command_function = command_function
+        self.update_function = update_function
+        self.timeout = timeout
+        self.pool = workers.WorkerPool("command", worker_num, queue_depth)
+
+    def dispatch(self, command_data, session, db):
+        """
+        Queue a command. Raises workers.PoolFull if the dispatcher is saturated
+
+        :param command_data:
+        :param session:
+        :param db:
+        :return PendingCommand:
+        """
+        command_id = command_data["id"]
+        log.debug(":{0}:Dispatching command, {1} commands queued".format(command_id, self.pool.queued()))
+        routing_task = self.pool.submit(self.command_function, command_data, session, db, add_to_updates_queue=False)
+        task = workers.Task()
+        def answer(finished_task):
+            '''Finish the command with the response, or with the Task the command function returned'''
+            try:
+                response = finished_task.result(0)
+            except Exception as command_exception:
+                task.set_exception(command_exception)
+                return
+            if isinstance(response, workers.Task):
+                workers.chain(response, task)
+            else:
+                task.set_result(response)
+        routing_task.add_done_callback(answer)
+        return PendingCommand(command_id, session, task, self.update_function)
@@ -0,0 +1,225 @@
+#Builtin imports
+import collections
+import logging
+import threading
+import time
+
+#External imports
+import requests
+
+#Internal imports
+import core.metrics as metrics
+import core.notification as notification
+import core.workers as workers
+
+log = logging.getLogger()
+
+#How many actions of each event type can run at once
+default_limits = {
+    "notification": 4,
+    "url": 4,
+    "function": 2
+}
+
+default_queue_depth = 256
+
+default_timeouts = {
+    "notification": 10,
+    "url": 10,
+    "function": 30
+}
+
+#Seconds to wait before retrying an event whose pool was saturated
+retry_delay = 1
+
+url_cache_size = 256
+
+event_lag_seconds = metrics.histogram(
+    "will_event_lag_seconds", "How long after its deadline an event action started", ["type"])
+
+
+class EventExecutor:
+    '''
+    Runs the actions of due events on bounded per-type worker pools,
+    so the monitor thread only has to decide what is due
+    '''
+    def __init__(self, db, update_function, retry_function, limits=None, queue_depth=default_queue_depth,
+                 timeouts=None):
+        """
+        :param db:
+        :param update_function: Called as update_function(username, update_data)
+        :param retry_function: Called with an event that couldn't be queued, after moving its time forward
+        :param limits: event type -> number of workers
+        :param queue_depth: Number of actions of each type that can wait for a worker
+        :param timeouts: event type -> seconds an action is allowed to take
+        """
+        self.db = db
+        self.update_function = update_function
+        self.retry_function = retry_function
+        self.limits = dict(default_limits)
+        self.limits.update(limits or {})
+        self.timeouts = dict(default_timeouts)
+        self.timeouts.update(timeouts or {})
+        self.pools = {}
+        self.deadlines = workers.Deadlines("event-deadlines")
+        for event_type, worker_num in self.limits.items():
+            self.pools.update({event_type: workers.WorkerPool("event-{0}".format(event_type), worker_num, queue_depth)})
+        self.actions = {
+            "notification": self.notify,
+            "url": self.open_url,
+            "function": self.run_function
+        }
+        #url -> {"etag", "last_modified", "text"} for conditional GETs
+        self._url_cache = collections.OrderedDict()
+        self._url_cache_lock = threading.Lock()
+        self._lag_lock = threading.Lock()
+        self.lag = {"fired": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+
+    def record_lag(self, event):
+        """
+        Track how late an event fired compared to its deadline, counting the time it spent waiting to be retried
+
+        :param event:
+        """
+        event_lag = max(time.time()-event.get("due", event["time"]), 0.0)
+        event_lag_seconds.observe(event_lag, type=event["type"])
+        with self._lag_lock:
+            self.lag["fired"] += 1
+            self.lag["total"] += event_lag
+            self.lag["last"] = event_lag
+            self.lag["max"] = max(self.lag["max"], event_lag)
+        return event_lag
+
+    def lag_stats(self):
+        """
+        :return dictionary with the number of fired events and their average, max and last lag in seconds:
+        """
+        with self._lag_lock:
+            stats = dict(self.lag)
+        stats.update({"average": stats["total"]/stats["fired"] if stats["fired"] else 0.0})
+        return stats
+
+    def fire(self, event):
+        """
+        Queue the action for a due event
+
+        :param event:
+        """
+        event_type = event["type"]
+        if event_type not in self.actions:
+            log.error("Unknown event type {0} for event {1}".format(event_type, event))
+            return
+        try:
+            self.pools[event_type].submit(self._run, event)
+        except workers.PoolFull:
+            log.warning("Event pool {0} is saturated, retrying event {1} in {2} seconds".format(
+                event_type, event["uid"], retry_delay
+            ))
+            #Lag is measured from when the event was first due, not from its retry
+            event.setdefault("due", event["time"])
+            event["time"] = time.time()+retry_delay
+            self.retry_function(event)
+
+    def _run(self, event):
+        """
+        Run an event action, logging its lag and any action that ran over its time budget
+
+        :param event:
+        """
+        event_lag = self.record_lag(event)
+        log.debug("Running event {0}, {1} seconds after its deadline".format(event["uid"], event_lag))
+        event_type = event["type"]
+        start_time = time.time()
+        try:
+            self.actions[event_type](event)
+        except Exception:
+            log.exception("Error running event {0}".format(event["uid"]))
+        run_time = time.time()-start_time
+        if run_time > self.timeouts[event_type]:
+            log.warning("Event {0} took {1} seconds, over its {2} second budget".format(
+                event["uid"], run_time, self.timeouts[event_type]
+            ))
+
+    def notify(self, event):
+        """
+        Push a notification to the users sessions and send it through their notification handlers
+
+        :param event:
+        """
+        username = event["username"]
+        #Active sessions for the user
+        self.update_function(username, event)
+        update_data = {"type": "notification", "text": event["value"], "data": event}
+        self.update_function(username, update_data)
+        notification.send_notification(event, self.db, timeout=self.timeouts["notification"])
+
+    def fetch_url(self, url):
+        """
+        GET a url, reusing the last response if the server says it hasn't changed
+
+        :param url:
+        :return page text:
+        """
+        headers = {}
+        with self._url_cache_lock:
+            cached = self._url_cache.get(url)
+        if cached:
+            if cached["etag"]:
+                headers.update({"If-None-Match": cached["etag"]})
+            if cached["last_modified"]:
+                headers.update({"If-Modified-Since": cached["last_modified"]})
+        url_response = requests.get(url, headers=headers, timeout=self.timeouts["url"])
+        if url_response.status_code == 304 and cached:
+            log.debug("Url {0} not modified, reusing cached response".format(url))
+            return cached["text"]
+        etag = url_response.headers.get("ETag")
+        last_modified = url_response.headers.get("Last-Modified")
+        if etag or last_modified:
+            with self._url_cache_lock:
+                self._url_cache.pop(url, None)
+                self._url_cache.update({url: {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "text": url_response.text
+                }})
+                while len(self._url_cache) > url_cache_size:
+                    self._url_cache.popitem(last=False)
+        return url_response.text
+
+    def open_url(self, event):
+        """
+        :param event:
+        """
+        response = self.fetch_url(event["value"])
+        update_data = {"type": "event", "text": response, "data": event}
+        self.update_function(event["username"], update_data)
+
+    def run_function(self, event):
+        """
+        Call a function event, answering the user with a timeout message if it runs past its budget.
+        The function can't be stopped, so a late result is dropped
+
+        :param event:
+        """
+        function_task = workers.Task()
+        def send_response(finished_task):
+            '''Send the user whichever of the result and the timeout came first'''
+            try:
+                response = finished_task.result(0)
+            except Exception:
+                #The error is logged by _run
+                return
+            update_data = {"type": "event", "text": response, "data": event}
+            self.update_function(event["username"], update_data)
+        function_task.add_done_callback(send_response)
+        timeout = self.timeouts["function"]
+        def timed_out():
+            '''Answer for the function if it hasn't finished by its deadline'''
+            if function_task.set_result("Event {0} didn't finish within {1} seconds".format(event["uid"], timeout)):
+                log.warning("Function event {0} ran past its {1} second timeout".format(event["uid"], timeout))
+        self.deadlines.add(timeout, timed_out)
+        try:
+            function_task.set_result(event["value"]())
+        except Exception as function_exception:
+            function_task.set_exception(function_exception)
+            raise
@@ -0,0 +1,201 @@
+#Builtin imports
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger()
+
+default_path = "events.journal"
+
+default_commit_interval = 0.05
+
+default_compact_interval = 300
+
+default_compact_records = 10000
+
+
+class EventJournal:
+    '''
+    Append-only log of event inserts and completions.
+    Records are grouped and fsynced together by a writer thread, and periodically
+    compacted into the events table so the journal stays short
+    '''
+    def __init__(self, path=default_path, commit_interval=default_commit_interval,
+                 compact_interval=default_compact_interval, compact_records=default_compact_records):
+        """
+        :param path: Path of the journal file. The rotated journal is kept next to it with a .old suffix
+        :param commit_interval: Seconds to wait for more records before committing a group
+        :param compact_interval: Seconds between compactions
+        :param compact_records: Compact early once the journal has this many records
+        """
+        self.path = path
+        self.old_path = path+".old"
+        self.commit_interval = commit_interval
+        self.compact_interval = compact_interval
+        self.compact_records = compact_records
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._records = 0
+        self._next_compaction = time.time()+compact_interval
+        self._file = open(path, "a")
+        self._snapshot_function = None
+        self._db = None
+        self._closed = False
+
+    def _append(self, record):
+        """
+        Queue a record for the next group commit
+
+        :param record:
+        """
+        line = json.dumps(record, default=str)
+        with self._condition:
+            self._pending.append(line)
+            self._condition.notify_all()
+
+    def record_insert(self, event):
+        """
+        :param event:
+        """
+        if event["type"] != "function":
+            self._append({"op": "insert", "event": event})
+
+    def record_done(self, event):
+        """
+        :param event: A fired or cancelled event
+        """
+        if event["type"] != "function":
+            self._append({"op": "done", "uid": event["uid"]})
+
+    def _read(self, path, pending):
+        """
+        Apply the records in a journal file to a dictionary of pending events
+
+        :param path:
+        :param pending: uid -> event
+        """
+        if not os.path.isfile(path):
+            return
+        with open(path) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #A torn write at the end of the journal from a crash
+                    log.warning("Skipping unreadable journal record {0}".format(line))
+                    continue
+                if record["op"] == "insert":
+                    event = record["event"]
+                    pending[event["uid"]] = event
+                elif record["op"] == "done":
+                    pending.pop(record["uid"], None)
+
+    def replay(self, pending):
+        """
+        Bring a dictionary of events loaded from the db up to date with the journal
+
+        :param pending: uid -> event
+        :return pending:
+        """
+        self._read(self.old_path, pending)
+        self._read(self.path, pending)
+        log.info("Replayed event journal, {0} events pending".format(len(pending)))
+        return pending
+
+    def _commit(self):
+        '''Write and fsync all pending records. The write lock has to be held'''
+        if self._closed:
+            return
+        with self._condition:
+            lines = self._pending
+            self._pending = []
+        if lines:
+            self._file.write("\n".join(lines)+"\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._records += len(lines)
+
+    def commit(self):
+        '''Write and fsync all pending records'''
+        with self._write_lock:
+            self._commit()
+
+    def compact(self):
+        '''Rotate the journal and write the pending events to the events table in bulk'''
+        with self._write_lock:
+            if self._closed:
+                return
+            self._commit()
+            self._file.close()
+            if os.path.isfile(self.old_path):
+                #The last compaction didn't reach the db, keep its records too
+                with open(self.old_path, "a") as old_file, open(self.path) as journal_file:
+                    old_file.write(journal_file.read())
+                os.remove(self.path)
+            else:
+                os.rename(self.path, self.old_path)
+            self._file = open(self.path, "a")
+            self._records = 0
+            self._next_compaction = time.time()+self.compact_interval
+            snapshot = [event for event in self._snapshot_function() if event["type"] != "function"]
+        rows = []
+        for event in snapshot:
+            row = dict(event)
+            row.pop("id", None)
+            rows.append(row)
+        db = self._db
+        db.begin()
+        try:
+            events_table = db["events"]
+            events_table.delete()
+            if rows:
+                events_table.insert_many(rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            log.exception("Error compacting event journal into the db, keeping {0}".format(self.old_path))
+            return
+        os.remove(self.old_path)
+        log.info("Compacted event journal, wrote {0} events to the db".format(len(rows)))
+
+    def _write_loop(self):
+        '''Writer thread that group commits records and runs compactions'''
+        while not self._closed:
+            with self._condition:
+                while not self._pending:
+                    remaining = self._next_compaction-time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            if self._pending:
+                #Let other records that are about to be written join this group
+                time.sleep(self.commit_interval)
+                self.commit()
+            if time.time() >= self._next_compaction or self._records >= self.compact_records:
+                try:
+                    self.compact()
+                except Exception:
+                    log.exception("Error compacting event journal")
+
+    def start(self, snapshot_function, db):
+        """
+        Start the writer thread
+
+        :param snapshot_function: Returns a list of all pending events
+        :param db:
+        """
+        self._snapshot_function = snapshot_function
+        self._db = db
+        writer_thread = threading.Thread(target=self._write_loop, name="event-journal")
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def close(self):
+        '''Commit everything that's still pending'''
+        with self._write_lock:
+            self._commit()
+            self._closed = True
+            self._file.close()
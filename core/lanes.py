@@ -0,0 +1,171 @@
+#Builtin imports
+import collections
+import logging
+import threading
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+#Internal imports
+import core.metrics as metrics
+import core.workers as workers
+
+log = logging.getLogger()
+
+#Lane name -> number of workers. Plugins say which lane they run in with the lane key of their subscription
+default_lanes = {
+    "fast": 8,
+    "slow": 16
+}
+
+#Lane plugins without a lane key run in
+default_lane = "slow"
+
+#Number of calls that can wait for a worker in each lane
+default_queue_depth = 64
+
+#Number of calls one user can have waiting in a lane
+default_user_depth = 8
+
+lane_queued = metrics.gauge("will_lane_queued", "Plugin calls waiting for a worker, by lane", ["lane"])
+
+lane_rejections = metrics.counter(
+    "will_lane_rejections_total", "Plugin calls turned away because a lane or a users share of it was full", ["lane"])
+
+
+class FairQueue:
+    '''
+    A bounded queue with a line for each user. Workers take from the users in turn,
+    so one user queueing a burst of calls doesn't hold up everyone else
+    '''
+    def __init__(self, name, queue_depth=default_queue_depth, user_depth=default_user_depth):
+        """
+        :param name: Lane name, used in metrics
+        :param queue_depth: Number of items that can wait across all users
+        :param user_depth: Number of items one user can have waiting
+        """
+        self.name = name
+        self.queue_depth = queue_depth
+        self.user_depth = user_depth
+        self._condition = threading.Condition()
+        #Username -> deque of items, in the order the users get their next turn
+        self._lines = collections.OrderedDict()
+        self._size = 0
+
+    def put(self, username, item):
+        """
+        Raises Queue.Full if the queue or the users line is full
+
+        :param username:
+        :param item:
+        """
+        with self._condition:
+            line = self._lines.get(username)
+            if self._size >= self.queue_depth or (line is not None and len(line) >= self.user_depth):
+                raise Queue.Full
+            if line is None:
+                line = collections.deque()
+                self._lines[username] = line
+            line.append(item)
+            self._size += 1
+            lane_queued.set(self._size, lane=self.name)
+            self._condition.notify()
+
+    def get(self):
+        """
+        Wait for an item, taking it from the user whose turn it is
+
+        :return item:
+        """
+        with self._condition:
+            while not self._size:
+                self._condition.wait()
+            username, line = next(iter(self._lines.items()))
+            item = line.popleft()
+            #Send the user to the back of the rotation, or drop them if they have nothing else waiting
+            del self._lines[username]
+            if line:
+                self._lines[username] = line
+            self._size -= 1
+            lane_queued.set(self._size, lane=self.name)
+            return item
+
+    def qsize(self):
+        """
+        :return number of items waiting:
+        """
+        return self._size
+
+    def waiting_users(self):
+        """
+        :return number of users with items waiting:
+        """
+        with self._condition:
+            return len(self._lines)
+
+
+class Lane(workers.WorkerPool):
+    '''
+    A worker pool for one class of plugins, with fair admission between users
+    '''
+    def __init__(self, name, worker_num, queue_depth=default_queue_depth, user_depth=default_user_depth):
+        """
+        :param name:
+        :param worker_num:
+        :param queue_depth: Number of calls that can wait for a worker
+        :param user_depth: Number of calls one user can have waiting
+        """
+        self.fair_queue = FairQueue(name, queue_depth, user_depth)
+        workers.WorkerPool.__init__(self, "lane-{0}".format(name), worker_num, queue_depth, self.fair_queue)
+        self.lane_name = name
+
+    def submit_for(self, username, function, *args, **kwargs):
+        """
+        Queue a function in the users line. Raises workers.PoolFull if the lane or the users line is full
+
+        :param username:
+        :param function:
+        :return Task:
+        """
+        task = workers.Task()
+        try:
+            self.fair_queue.put(username, (task, function, args, kwargs))
+        except Queue.Full:
+            lane_rejections.inc(lane=self.lane_name)
+            raise workers.PoolFull("Lane {0} is saturated for user {1}".format(self.lane_name, username))
+        return task
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue a function that isn't run for a particular user
+
+        :param function:
+        :return Task:
+        """
+        return self.submit_for(None, function, *args, **kwargs)
+
+    def to_dict(self):
+        """
+        :return json serializable dictionary of the lane state:
+        """
+        return {
+            "lane": self.lane_name,
+            "workers": self.workers,
+            "active": self.active(),
+            "queued": self.queued(),
+            "waiting_users": self.fair_queue.waiting_users()
+        }
+
+
+def start_lanes(lane_workers=None, queue_depth=default_queue_depth, user_depth=default_user_depth):
+    """
+    :param lane_workers: Lane name -> number of workers, merged over default_lanes
+    :param queue_depth:
+    :param user_depth:
+    :return lane name -> Lane:
+    """
+    limits = dict(default_lanes)
+    limits.update(lane_workers or {})
+    return dict((lane_name, Lane(lane_name, worker_num, queue_depth, user_depth))
+                for lane_name, worker_num in limits.items())
@@ -0,0 +1,128 @@
+#Builtin imports
+import logging
+import threading
+
+#Internal imports
+import core.metrics as metrics
+import core.tracing as tracing
+
+log = logging.getLogger()
+
+#Pipeline stages in the order they have to run
+stages = ["tagger", "parser", "ner"]
+
+stage_seconds = metrics.histogram(
+    "will_parse_stage_seconds", "Time spent running a stage of the pipeline on a lazily parsed command", ["stage"])
+
+
+def pipeline_stages(nlp):
+    """
+    :param nlp: A loaded spaCy language
+    :return list of (stage, pipe) for the stages the model has:
+    """
+    #spaCy 2 names its pipes, spaCy 1 has them as attributes
+    if hasattr(nlp, "get_pipe"):
+        return [(stage, nlp.get_pipe(stage)) for stage in stages if stage in nlp.pipe_names]
+    pipes = {"tagger": nlp.tagger, "parser": nlp.parser, "ner": nlp.entity}
+    return [(stage, pipes[stage]) for stage in stages if pipes[stage] is not None]
+
+
+class LazyDoc:
+    '''
+    A command that's only tokenized until something needs a later stage of the pipeline.
+    Asking for a stage runs it and any earlier stages that haven't run yet, once
+    '''
+    def __init__(self, text, nlp, pipes, doc_cache=None, trace=None, full_parse=None):
+        """
+        :param text:
+        :param nlp: A loaded spaCy language
+        :param pipes: list of (stage, pipe) from pipeline_stages
+        :param doc_cache: A ParseCache fully parsed documents are looked up in and added to
+        :param trace: The trace of the command
+        :param full_parse: Function that parses a text in one go, used instead of the pipes when the last stage is
+        needed, so the deferred parse can go through the parse batcher. It's expected to add to the doc cache itself
+        """
+        self.text = text
+        self.pipes = pipes
+        self.doc_cache = doc_cache
+        self.trace = trace
+        self.full_parse = full_parse
+        self._lock = threading.Lock()
+        cached = doc_cache.get(text) if doc_cache is not None else None
+        if cached is not None:
+            self._doc = cached
+            self._done = len(pipes)
+        else:
+            self._doc = nlp.tokenizer(text)
+            self._done = 0
+
+    def tokens(self):
+        """
+        :return the document, which is at least tokenized:
+        """
+        return self._doc
+
+    def require(self, stage):
+        """
+        Run the pipeline up to and including a stage
+
+        :param stage: One of stages. Stages the model doesn't have are skipped
+        :return the document:
+        """
+        stage_index = stages.index(stage)
+        with self._lock:
+            if self.full_parse is not None and self._done < len(self.pipes) and \
+                    stage_index >= stages.index(self.pipes[-1][0]):
+                span = self.trace.span("parse") if self.trace else tracing.null_span
+                with span:
+                    self._doc = self.full_parse(self.text)
+                self._done = len(self.pipes)
+                return self._doc
+            while self._done < len(self.pipes) and stages.index(self.pipes[self._done][0]) <= stage_index:
+                pipe_stage, pipe = self.pipes[self._done]
+                span = self.trace.span("parse:{0}".format(pipe_stage)) if self.trace else tracing.null_span
+                with stage_seconds.time(stage=pipe_stage), span:
+                    pipe(self._doc)
+                self._done += 1
+                if self._done == len(self.pipes) and self.doc_cache is not None:
+                    self.doc_cache.put(self.text, self._doc)
+        return self._doc
+
+    def full(self):
+        """
+        :return the document after every stage has run:
+        """
+        return self.require(stages[-1])
+
+    def done_stages(self):
+        """
+        :return list of the stages that have run:
+        """
+        return [stage for stage, pipe in self.pipes[:self._done]]
+
+
+class LazyEvent(dict):
+    '''
+    An event whose doc, verbs and ents keys are filled in the first time they're looked up
+    '''
+    def __init__(self, lazy_doc, *args, **kwargs):
+        """
+        :param lazy_doc:
+        """
+        dict.__init__(self, *args, **kwargs)
+        self.lazy_doc = lazy_doc
+
+    def __missing__(self, key):
+        if key == "doc":
+            value = self.lazy_doc.full()
+        elif key in ("verbs", "ents"):
+            value = getattr(self["parsed"], key)
+        else:
+            raise KeyError(key)
+        return self.setdefault(key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -0,0 +1,298 @@
+#Builtin imports
+import bisect
+import logging
+import threading
+import time
+
+log = logging.getLogger()
+
+#Upper bounds in seconds of the default histogram buckets
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    """
+    :param label_names:
+    :param label_values:
+    :param extra: An extra (name, value) pair, like a histogram bucket bound
+    :return label string for the exposition format:
+    """
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs
+    ) + "}"
+
+
+def _format_value(value):
+    """
+    :param value:
+    :return number formatted for the exposition format:
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    '''
+    Base class for a named metric with optional labels
+    '''
+    metric_type = None
+
+    def __init__(self, name, description, label_names=()):
+        """
+        :param name:
+        :param description:
+        :param label_names: Names of the labels every sample has to be given
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """
+        :param labels:
+        :return tuple of label values in label_names order:
+        """
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def samples(self):
+        """
+        :return list of (name suffix, label string, value):
+        """
+        with self._lock:
+            values = list(self._values.items())
+        return [("", _format_labels(self.label_names, key), value) for key, value in sorted(values)]
+
+    def render(self):
+        """
+        :return the metric in the text exposition format:
+        """
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.description),
+            "# TYPE {0} {1}".format(self.name, self.metric_type)
+        ]
+        for suffix, label_string, value in self.samples():
+            lines.append("{0}{1}{2} {3}".format(self.name, suffix, label_string, _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    '''
+    A value that only goes up
+    '''
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        :param amount:
+        :param labels:
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0)+amount
+
+    def value(self, **labels):
+        """
+        :param labels:
+        :return current value:
+        """
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    '''
+    A value that can go up and down, or be read from a function when it's rendered
+    '''
+    metric_type = "gauge"
+
+    def __init__(self, name, description, label_names=(), function=None):
+        """
+        :param function: If set, called with no arguments to read the value. Only for gauges without labels
+        """
+        Metric.__init__(self, name, description, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        """
+        :param value:
+        :param labels:
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """
+        :param amount:
+        :param labels:
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0)+amount
+
+    def dec(self, amount=1, **labels):
+        """
+        :param amount:
+        :param labels:
+        """
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        """
+        :param labels:
+        :return current value:
+        """
+        if self.function:
+            return self.function()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function:
+            try:
+                return [("", "", self.function())]
+            except Exception:
+                log.exception("Error reading gauge {0}".format(self.name))
+                return []
+        return Metric.samples(self)
+
+
+class _Timer:
+    '''Context manager that observes the time spent in its block'''
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.histogram.observe(time.time()-self.start_time, **self.labels)
+        return False
+
+
+class Histogram(Metric):
+    '''
+    Counts of observed values in fixed buckets, plus their sum and count
+    '''
+    metric_type = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=default_buckets):
+        """
+        :param buckets: Sorted bucket upper bounds, +Inf is added automatically
+        """
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        :param value:
+        :param labels:
+        """
+        key = self._key(labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._values.get(key)
+            if sample is None:
+                sample = {"buckets": [0]*(len(self.buckets)+1), "sum": 0.0, "count": 0}
+                self._values[key] = sample
+            sample["buckets"][bucket_index] += 1
+            sample["sum"] += value
+            sample["count"] += 1
+
+    def time(self, **labels):
+        """
+        Time a block with a with statement
+
+        :param labels:
+        :return context manager:
+        """
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        """
+        :param labels:
+        :return number of observations:
+        """
+        sample = self._values.get(self._key(labels))
+        return sample["count"] if sample else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, {"buckets": list(sample["buckets"]), "sum": sample["sum"], "count": sample["count"]})
+                      for key, sample in self._values.items()]
+        samples = []
+        for key, sample in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets+(float("inf"),), sample["buckets"]):
+                cumulative += bucket_count
+                samples.append(("_bucket", _format_labels(self.label_names, key, ("le", _format_value(bound))),
+                                cumulative))
+            samples.append(("_sum", _format_labels(self.label_names, key), sample["sum"]))
+            samples.append(("_count", _format_labels(self.label_names, key), sample["count"]))
+        return samples
+
+
+class Registry:
+    '''
+    A set of metrics rendered together
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Register a metric, or return the one already registered under its name
+
+        :param metric:
+        :return the registered metric:
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def get(self, name):
+        """
+        :param name:
+        :return the metric or None:
+        """
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        :return every metric in the text exposition format:
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "\n".join(metric.render() for metric in metrics)+"\n"
+
+
+registry = Registry()
+
+
+def counter(name, description, label_names=()):
+    """
+    :return a Counter registered in the default registry:
+    """
+    return registry.register(Counter(name, description, label_names))
+
+
+def gauge(name, description, label_names=(), function=None):
+    """
+    :return a Gauge registered in the default registry:
+    """
+    return registry.register(Gauge(name, description, label_names, function))
+
+
+def histogram(name, description, label_names=(), buckets=default_buckets):
+    """
+    :return a Histogram registered in the default registry:
+    """
+    return registry.register(Histogram(name, description, label_names, buckets))
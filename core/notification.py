@@ -13,7 +13,7 @@ class send_notification():
     Send all necessary notifications
     """
     @staticmethod
-    def email(mailgun_key, mailgun_url, email, msg_summary, msg, first_name, last_name):
+    def email(mailgun_key, mailgun_url, email, msg_summary, msg, first_name, last_name, timeout=None):
         """
         Send an email to the user
 
@@ -24,6 +24,7 @@ class send_notification():
         :param msg:
         :param first_name:
         :param last_name:
+        :param timeout: Seconds to wait for mailgun
         """
         return requests.post(
             mailgun_url,
@@ -31,13 +32,15 @@ class send_notification():
             data={"from": "W.I.L.L <postmaster@willbeddow.com>",
                   "to": "{0} {1} <{2}>".format(first_name,last_name,email),
                   "subject": msg_summary,
-                  "text": msg})
-    def __init__(self, notification, db):
+                  "text": msg},
+            timeout=timeout)
+    def __init__(self, notification, db, timeout=None):
         """
         Determine what notifications to send and send them
 
         :param notification:
         :param db:
+        :param timeout: Seconds to wait for each notification handler
         """
         username = notification['username']
         user_table = db['users'].find_one(username=username)
@@ -67,6 +70,7 @@ class send_notification():
                 first_name = user_table["first_name"]
                 last_name = user_table["last_name"]
                 log.info("Sending email with subject {0} to email {1}".format(msg_summary, user_email))
-                send_notification.email(mailgun_key, mailgun_url, user_email, msg_summary, msg, first_name, last_name)
+                send_notification.email(mailgun_key, mailgun_url, user_email, msg_summary, msg, first_name, last_name,
+                                        timeout=timeout)
                 log.debug("Successfully sent email with subject {0} to email {1}".format(msg_summary, user_email))
             #TODO: add options for more notification methods (phone, W.I.L.L-Telegram, etc.)
\ No newline at end of file
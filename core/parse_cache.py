@@ -0,0 +1,112 @@
+#Builtin imports
+import collections
+import logging
+import re
+import threading
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+default_max_entries = 1024
+
+#Rough upper bound on the memory held by cached parses
+default_max_bytes = 64*1024*1024
+
+#Estimated memory used by each token of a parsed document, including its share of the document vector
+token_bytes = 4096
+
+cache_lookups = metrics.counter("will_parse_cache_total", "Parse cache lookups", ["result"])
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize(text):
+    """
+    Collapse whitespace so trivially different commands share an entry. Case is kept, the tagger and
+    entity recognizer depend on it
+
+    :param text:
+    :return cache key:
+    """
+    return _whitespace.sub(" ", text).strip()
+
+
+def estimate_size(text, doc):
+    """
+    :param text:
+    :param doc:
+    :return estimated bytes used by a cached parse:
+    """
+    return len(text)+len(doc)*token_bytes
+
+
+class ParseCache:
+    '''
+    A thread safe least recently used cache of parsed documents, bounded by entry count and estimated memory
+    '''
+    def __init__(self, max_entries=default_max_entries, max_bytes=default_max_bytes):
+        """
+        :param max_entries:
+        :param max_bytes:
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        #key -> (doc, size)
+        self._entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        """
+        :param text:
+        :return the cached parse, or None:
+        """
+        key = normalize(text)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries[key] = entry
+                self.hits += 1
+        cache_lookups.inc(result="miss" if entry is None else "hit")
+        return entry[0] if entry else None
+
+    def put(self, text, doc):
+        """
+        :param text:
+        :param doc:
+        """
+        key = normalize(text)
+        entry_size = estimate_size(key, doc)
+        if entry_size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry:
+                self.size -= old_entry[1]
+            self._entries[key] = (doc, entry_size)
+            self.size += entry_size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                evicted_doc, evicted_size = self._entries.popitem(last=False)[1]
+                self.size -= evicted_size
+
+    def clear(self):
+        '''Drop every cached parse'''
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        :return dictionary of the entry count, estimated size, hits and misses:
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._entries)
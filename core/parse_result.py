@@ -0,0 +1,261 @@
+#Builtin imports
+import logging
+
+#External imports
+import numpy
+
+log = logging.getLogger()
+
+
+def _lemmas(doc):
+    return frozenset(token.lemma_.lower() for token in doc)
+
+
+def _verbs(doc):
+    return frozenset(token.lemma_.lower() for token in doc if token.pos_ == "VERB")
+
+
+def _ents(doc):
+    #Entity label -> text of the last entity with that label
+    return dict((ent.label_, ent.text) for ent in doc.ents)
+
+
+def _noun_chunks(doc):
+    #(chunk text, dependency of the chunk root) for every noun chunk
+    return tuple((chunk.text, chunk.root.dep_) for chunk in doc.noun_chunks)
+
+
+class _Features(object):
+    '''Methods shared by ParseResult and LazyParseResult'''
+    __slots__ = ()
+
+    def chunks_with_dep(self, *deps):
+        """
+        :param deps: Dependency labels like dobj or pobj
+        :return list of the text of noun chunks whose root has one of the dependencies:
+        """
+        return [text for text, dep in self.noun_chunks if dep in deps]
+
+    def to_dict(self):
+        """
+        :return json serializable dictionary of the features:
+        """
+        return {
+            "command": self.command,
+            "words": sorted(self.words),
+            "lemmas": sorted(self.lemmas),
+            "verbs": sorted(self.verbs),
+            "ents": dict(self.ents),
+            "noun_chunks": [list(chunk) for chunk in self.noun_chunks],
+            "first_word": self.first_word
+        }
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, self.command)
+
+
+class ParseResult(_Features):
+    '''
+    Lexical features of a parsed command, computed once so check functions and plugins don't have to walk the
+    document again. It doesn't keep the document, so it's small and picklable
+    '''
+    __slots__ = ("command", "words", "lemmas", "verbs", "ents", "noun_chunks", "first_word", "vector")
+
+    def __init__(self, command, doc):
+        """
+        :param command: The command text
+        :param doc: A spaCy Doc or CompactDoc of the command
+        """
+        self.command = command
+        #Lowercase text of every token
+        self.words = frozenset(token.orth_.lower() for token in doc)
+        self.lemmas = _lemmas(doc)
+        self.verbs = _verbs(doc)
+        self.ents = _ents(doc)
+        self.noun_chunks = _noun_chunks(doc)
+        self.first_word = doc[0].orth_.lower() if len(doc) else ""
+        #The average of the word vectors. None for a CompactDoc made without one
+        self.vector = doc.vector
+
+
+class LazyParseResult(_Features):
+    '''
+    The same features as ParseResult, for a LazyDoc. Words only need the tokenizer, the rest run the stage of the
+    pipeline they depend on the first time they're read
+    '''
+    __slots__ = ("command", "lazy_doc", "words", "first_word", "_lemmas", "_verbs", "_ents", "_noun_chunks")
+
+    def __init__(self, command, lazy_doc):
+        """
+        :param command: The command text
+        :param lazy_doc: A LazyDoc of the command
+        """
+        self.command = command
+        self.lazy_doc = lazy_doc
+        doc = lazy_doc.tokens()
+        self.words = frozenset(token.orth_.lower() for token in doc)
+        self.first_word = doc[0].orth_.lower() if len(doc) else ""
+        self._lemmas = None
+        self._verbs = None
+        self._ents = None
+        self._noun_chunks = None
+
+    @property
+    def lemmas(self):
+        if self._lemmas is None:
+            self._lemmas = _lemmas(self.lazy_doc.require("tagger"))
+        return self._lemmas
+
+    @property
+    def verbs(self):
+        if self._verbs is None:
+            self._verbs = _verbs(self.lazy_doc.require("tagger"))
+        return self._verbs
+
+    @property
+    def ents(self):
+        if self._ents is None:
+            self._ents = _ents(self.lazy_doc.require("ner"))
+        return self._ents
+
+    @property
+    def noun_chunks(self):
+        if self._noun_chunks is None:
+            self._noun_chunks = _noun_chunks(self.lazy_doc.require("parser"))
+        return self._noun_chunks
+
+    @property
+    def vector(self):
+        #Word vectors come from the vocabulary, so the tokens are enough for the document vector
+        return self.lazy_doc.tokens().vector
+
+
+class CompactDoc:
+    '''
+    A picklable copy of the parts of a spaCy Doc that plugins use, so a parse can be sent back from a worker process.
+    Iterating over it, its noun_chunks and ents, and similarity work the same way as on a Doc
+    '''
+    def __init__(self, text, tokens, noun_chunks, ents, vector=None):
+        """
+        :param text:
+        :param tokens: list of (orth, whitespace, lemma, pos, tag, dep, head index)
+        :param noun_chunks: list of (start, end) token offsets
+        :param ents: list of (start, end, label)
+        :param vector: The document vector, or None
+        """
+        self.text = text
+        self.tokens = tokens
+        self.noun_chunk_offsets = noun_chunks
+        self.ent_offsets = ents
+        self.vector = vector
+
+    @classmethod
+    def from_doc(cls, doc, with_vector=True):
+        """
+        :param doc: A spaCy Doc
+        :param with_vector: Whether to keep the document vector for similarity
+        :return CompactDoc:
+        """
+        tokens = [(token.orth_, token.whitespace_, token.lemma_, token.pos_, token.tag_, token.dep_, token.head.i)
+                  for token in doc]
+        noun_chunks = [(chunk.start, chunk.end) for chunk in doc.noun_chunks]
+        ents = [(ent.start, ent.end, ent.label_) for ent in doc.ents]
+        vector = doc.vector if with_vector else None
+        return cls(doc.text, tokens, noun_chunks, ents, vector)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, i):
+        return CompactToken(self, i)
+
+    def __iter__(self):
+        for i in range(len(self.tokens)):
+            yield CompactToken(self, i)
+
+    @property
+    def noun_chunks(self):
+        return [CompactSpan(self, start, end) for start, end in self.noun_chunk_offsets]
+
+    @property
+    def ents(self):
+        return [CompactSpan(self, start, end, label) for start, end, label in self.ent_offsets]
+
+    def similarity(self, other):
+        """
+        Cosine similarity of the document vectors, like Doc.similarity
+
+        :param other: A CompactDoc or spaCy Doc
+        :return float:
+        """
+        if self.vector is None or other.vector is None:
+            log.warning("Can't compare {0} and {1} without document vectors".format(self.text, other.text))
+            return 0.0
+        norms = numpy.linalg.norm(self.vector)*numpy.linalg.norm(other.vector)
+        if not norms:
+            return 0.0
+        return float(numpy.dot(self.vector, other.vector)/norms)
+
+    def __repr__(self):
+        return self.text
+
+
+class CompactToken:
+    '''A token of a CompactDoc'''
+    def __init__(self, doc, i):
+        """
+        :param doc:
+        :param i: Index of the token in the document
+        """
+        self.doc = doc
+        self.i = i
+        self.orth_, self.whitespace_, self.lemma_, self.pos_, self.tag_, self.dep_, self.head_i = doc.tokens[i]
+        self.text = self.orth_
+
+    @property
+    def head(self):
+        return CompactToken(self.doc, self.head_i)
+
+    @property
+    def lefts(self):
+        return [CompactToken(self.doc, i) for i in range(self.i) if self.doc.tokens[i][6] == self.i]
+
+    @property
+    def rights(self):
+        return [CompactToken(self.doc, i) for i in range(self.i+1, len(self.doc.tokens))
+                if self.doc.tokens[i][6] == self.i]
+
+    def __repr__(self):
+        return self.text
+
+
+class CompactSpan:
+    '''A noun chunk or entity of a CompactDoc'''
+    def __init__(self, doc, start, end, label=""):
+        """
+        :param doc:
+        :param start:
+        :param end:
+        :param label: The entity label
+        """
+        self.doc = doc
+        self.start = start
+        self.end = end
+        self.label_ = label
+        self.text = "".join(
+            orth+whitespace for orth, whitespace, lemma, pos, tag, dep, head in doc.tokens[start:end]).strip()
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield CompactToken(self.doc, i)
+
+    @property
+    def root(self):
+        '''The token whose head is outside the span'''
+        for token in self:
+            if token.head_i == token.i or not self.start <= token.head_i < self.end:
+                return token
+        return CompactToken(self.doc, self.start)
+
+    def __repr__(self):
+        return self.text
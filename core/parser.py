@@ -1,5 +1,7 @@
 #Builtin imports
 import logging
+import multiprocessing
+import threading
 
 #External imports
 import spacy
@@ -7,16 +9,262 @@ import dataset
 from spacy.symbols import nsubj, VERB
 from spacy.matcher import Matcher
 
+#Internal imports
+import core.metrics as metrics
+import core.batcher as batcher
+import core.parse_result as parse_result
+import core.parse_cache as parse_cache
+import core.lazy_parse as lazy_parse
+
 log = logging.getLogger()
 
-log.debug("In parser, loading model")
-try:
-    nlp = spacy.load('en')
-    log.debug("Loaded model")
-    matcher = Matcher(nlp.vocab)
-    log.debug("Loaded matcher")
-except RuntimeError:
-    log.warning("IMPORTANT! spaCy English model is not installed. To functionally use W.I.L.L it needs to be installed with python -m spacy.en.download")
+parse_seconds = metrics.histogram("will_parse_seconds", "Time spent parsing commands with spaCy")
+
+#Seconds to wait for a worker process to parse a command
+default_pool_timeout = 10
+
+#Model commands are routed with
+default_model = 'en'
+
+#Set by set_models. Name of the model commands are routed with
+model_name = default_model
+
+#Set by set_models. Name of the larger model used for plugins that need vectors or entities,
+#None if the routing model is used for everything
+full_model_name = None
+full_nlp = None
+full_model_lock = threading.Lock()
+
+#Set by start_batcher. When it's None each command is parsed on its own
+parse_batcher = None
+
+#Set by start_process_pool. When it's set commands are parsed in worker processes instead
+parse_pool = None
+pool_timeout = default_pool_timeout
+
+#Set by start_cache. Parsed documents keyed by normalized text, for the routing and full models
+doc_cache = None
+full_cache = None
+
+#Set by start_lazy_parsing. The (stage, pipe) list commands are lazily run through
+lazy_pipes = None
+
+#Set by set_models. Nothing is loaded at import, so importing the parser doesn't cost a model load
+nlp = None
+matcher = None
+
+def set_models(model=default_model, full_model=None):
+    """
+    Choose the model tiers. Call it before the parser is started
+
+    :param model: The small model every command is routed with
+    :param full_model: The larger model loaded the first time a plugin needs vectors or entities.
+    If it's None the routing model is used for everything
+    """
+    global nlp, matcher, model_name, full_model_name, full_nlp
+    if nlp is None or model != model_name:
+        log.info("Loading routing model {0}".format(model))
+        try:
+            nlp = spacy.load(model)
+        except RuntimeError:
+            log.error("IMPORTANT! spaCy model {0} is not installed. To functionally use W.I.L.L it needs to be "
+                      "installed with python -m spacy.en.download".format(model))
+            raise
+        matcher = Matcher(nlp.vocab)
+    model_name = model
+    #When both tiers name the same model full_model reuses the routing model instead of loading it twice
+    full_name = full_model if full_model != model else None
+    if full_name != full_model_name:
+        full_nlp = None
+    full_model_name = full_name
+
+def full_model():
+    """
+    :return the full model, loading it if it hasn't been yet:
+    """
+    global full_nlp
+    if full_model_name is None:
+        return nlp
+    with full_model_lock:
+        if full_nlp is None:
+            log.info("Loading full model {0}".format(full_model_name))
+            full_nlp = spacy.load(full_model_name)
+    return full_nlp
+
+def full_model_label():
+    """
+    :return name of the model parse_full uses:
+    """
+    return full_model_name if full_model_name is not None else model_name
+
+def full_model_loaded():
+    """
+    :return boolean, whether parse_full can run without loading a model:
+    """
+    return (nlp if full_model_name is None else full_nlp) is not None
+
+def start_batcher(window=batcher.default_window, batch_size=batcher.default_batch_size):
+    """
+    Parse commands that arrive within window seconds of each other together with nlp.pipe
+
+    :param window:
+    :param batch_size:
+    """
+    global parse_batcher
+    parse_batcher = batcher.ParseBatcher(nlp.pipe, window=window, batch_size=batch_size)
+    parse_batcher.start()
+
+def _init_worker(model):
+    """
+    Load the model in a worker process, unless the one inherited from the parent is already it
+
+    :param model: The routing model the parent is configured with
+    """
+    global nlp, model_name
+    if nlp is None or model_name != model:
+        nlp = spacy.load(model)
+        model_name = model
+
+def _parse_in_worker(text):
+    """
+    :param text:
+    :return CompactDoc:
+    """
+    return parse_result.CompactDoc.from_doc(nlp(text))
+
+def start_process_pool(processes=None, timeout=default_pool_timeout):
+    """
+    Parse commands in a pool of worker processes, so parsing isn't limited to the core the server runs on.
+    Start it before any other threads, the workers are forked from this process
+
+    :param processes: Number of worker processes, defaults to the number of cores
+    :param timeout: Seconds to wait for a worker to parse a command
+    """
+    global parse_pool, pool_timeout
+    pool_timeout = timeout
+    parse_pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(model_name,))
+
+def start_cache(max_entries=parse_cache.default_max_entries, max_bytes=parse_cache.default_max_bytes):
+    """
+    Keep recently parsed texts so repeated commands skip the pipeline
+
+    :param max_entries:
+    :param max_bytes:
+    """
+    global doc_cache, full_cache
+    doc_cache = parse_cache.ParseCache(max_entries=max_entries, max_bytes=max_bytes)
+    full_cache = parse_cache.ParseCache(max_entries=max_entries, max_bytes=max_bytes)
+
+def parse_text(text):
+    """
+    Parse a text, using the cache if it's running
+
+    :param text:
+    :return a spaCy Doc, or a CompactDoc if it was parsed in a worker process:
+    """
+    if doc_cache is None:
+        return run_pipeline(text)
+    doc = doc_cache.get(text)
+    if doc is None:
+        doc = run_pipeline(text)
+        doc_cache.put(text, doc)
+    return doc
+
+def timed_parse(text):
+    """
+    Parse a text like parse_text, recording the time it took
+
+    :param text:
+    :return a spaCy Doc, or a CompactDoc if it was parsed in a worker process:
+    """
+    with parse_seconds.time():
+        return parse_text(text)
+
+def run_pipeline(text):
+    """
+    Run a text through the pipeline in whichever way is configured
+
+    :param text:
+    :return a spaCy Doc, or a CompactDoc if it was parsed in a worker process:
+    """
+    if parse_pool:
+        return parse_pool.apply_async(_parse_in_worker, (text,)).get(pool_timeout)
+    if parse_batcher:
+        return parse_batcher.parse(text)
+    return nlp(text)
+
+def parse_full(text):
+    """
+    Parse a text with the full model
+
+    :param text:
+    :return a spaCy Doc:
+    """
+    if full_model_name is None:
+        return parse_text(text)
+    if full_cache is None:
+        return full_model()(text)
+    doc = full_cache.get(text)
+    if doc is None:
+        doc = full_model()(text)
+        full_cache.put(text, doc)
+    return doc
+
+def upgrade_event(event):
+    """
+    Replace the routing parse of an event with the full models, for plugins that need vectors or entities
+
+    :param event:
+    :return the event:
+    """
+    if event.get("model") == "full":
+        return event
+    #Check functions can run at the same time, so only let one of them upgrade the event
+    with event.setdefault("upgrade_lock", threading.Lock()):
+        if event.get("model") != "full":
+            _upgrade(event)
+    return event
+
+def _upgrade(event):
+    """
+    :param event:
+    """
+    if full_model_name is not None:
+        command = event["command"]
+        doc = parse_full(command)
+        parsed = parse_result.ParseResult(command, doc)
+        event.update({
+            "doc": doc,
+            "parsed": parsed,
+            "verbs": parsed.verbs,
+            "ents": parsed.ents,
+            "parse": parse_full
+        })
+    event.update({"model": "full"})
+
+def start_lazy_parsing():
+    '''Only tokenize commands up front, running the rest of the pipeline when a plugin needs it'''
+    global lazy_pipes
+    lazy_pipes = lazy_parse.pipeline_stages(nlp)
+
+def phrase_event(command_data, session, phrase):
+    """
+    Build the event for a command that matched a registered phrase, without parsing it
+
+    :param command_data:
+    :param session:
+    :param phrase: The normalized phrase the command matched
+    :return event_data:
+    """
+    return {
+        "command": command_data["command"],
+        "session": session,
+        "command_data": command_data,
+        "trace": command_data.get("trace"),
+        "phrase": phrase,
+        "parse": parse_text
+    }
+
 def parse(command_data, session):
     """
     Call the parser
@@ -31,31 +279,30 @@ def parse(command_data, session):
             command, username
         )
      )
-    #Parse the command in spacy
-    log.info("Running command through nlp")
-    doc = nlp(command)
-    verbs = set()
-    log.info("Parsing through dependencies")
-    for token in doc:
-        if token.pos == VERB:
-            verbs.add(token.lemma_.lower())
-    log.info("Finished parsing dependencies, parsing ents")
-    ents = {}
-    #Use spacy's ent recognition
-    for ent in doc.ents:
-        ents.update({
-            ent.label_:ent.text
-        })
-    log.info("Finished parsing ents")
     event_data = {
         "command": command,
         "session": session,
         "command_data": command_data,
-        "verbs": verbs,
-        "ents": ents,
-        "doc": doc,
-        "parse": lambda x: nlp(x)
+        "trace": command_data.get("trace"),
+        "parse": parse_text
     }
+    #Worker processes return complete documents, so there's nothing to do lazily
+    if lazy_pipes is not None and not parse_pool:
+        log.info("Tokenizing command")
+        lazy_doc = lazy_parse.LazyDoc(command, nlp, lazy_pipes, doc_cache, command_data.get("trace"), timed_parse)
+        event_data = lazy_parse.LazyEvent(lazy_doc, event_data)
+        event_data.update({"parsed": parse_result.LazyParseResult(command, lazy_doc)})
+        return event_data
+    #Parse the command in spacy
+    log.info("Running command through nlp")
+    doc = timed_parse(command)
+    parsed = parse_result.ParseResult(command, doc)
+    event_data.update({
+        "parsed": parsed,
+        "verbs": parsed.verbs,
+        "ents": parsed.ents,
+        "doc": doc
+    })
     log.info("Finished parsing event_data, sending it into events queue")
     log.debug("Event_data is {0}".format(event_data))
     return event_data
@@ -1,13 +1,24 @@
 #Builtin imports
 import logging
 import os
+import re
 import sys
-import time
+import threading
 import traceback
 
 #External imports
 import importlib
 
+#Internal imports
+import core.metrics as metrics
+import core.tracing as tracing
+import core.parser as parser
+import core.check_runner as check_runner
+import core.breaker as breaker
+import core.lanes as lanes
+import core.response_cache as response_cache
+import core.workers as workers
+
 log = logging.getLogger()
 
 dir_path = 'core/plugins'
@@ -18,27 +29,183 @@ command_plugins = {}
 
 default_plugin_data = None
 
+#Normalized phrase -> subscription of the plugin that handles it, matched before commands are parsed
+phrase_table = {}
+
+#Plugin name -> subscription
+plugins_by_name = {}
+
+#Trigger kind -> value -> subscriptions whose check is run when a command has the value
+trigger_index = {}
+
+#Subscriptions without triggers, their checks run on every command
+untriggered_plugins = []
+
+#Subscriptions with triggers and check_unmatched, their checks also run on commands no plugin matched
+unmatched_plugins = []
+
+#Set by start_check_runner. When it's None check functions run one after another
+checks = None
+
+#Seconds a plugin can run before its caller gets a timeout response, unless its subscription has a timeout
+default_plugin_timeout = 20
+
+#Set by start_lanes, lane name -> Lane. When it's None plugins run in the callers thread without a deadline
+plugin_lanes = None
+plugin_timeout = default_plugin_timeout
+
+#Set by start_lanes. Created there instead of at import, so no thread is running before the parser processes fork
+deadlines = None
+
+breakers = breaker.BreakerRegistry()
+
+#Responses of plugins with a cache policy
+responses = response_cache.ResponseCache()
+
+#(plugin name, coalesce key) -> Task of the call callers with the same key share
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+#Trigger kind -> function returning the values of a ParseResult to look up
+trigger_features = {
+    "words": lambda parsed: parsed.words,
+    "lemmas": lambda parsed: parsed.lemmas,
+    "verbs": lambda parsed: parsed.verbs,
+    "first_words": lambda parsed: (parsed.first_word,)
+}
+
+plugin_seconds = metrics.histogram("will_plugin_seconds", "Time spent running plugins", ["plugin"])
+
+plugin_errors = metrics.counter("will_plugin_errors_total", "Plugin calls that raised an exception", ["plugin"])
+
+plugin_timeouts = metrics.counter("will_plugin_timeouts_total", "Plugin calls that ran past their deadline", ["plugin"])
+
+plugin_fallbacks = metrics.counter(
+    "will_plugin_fallbacks_total", "Commands answered by a fallback because a plugin was unavailable", ["plugin"])
+
+db_seconds = metrics.histogram("will_db_seconds", "Time spent in db queries", ["operation"])
+
+route_candidates = metrics.histogram(
+    "will_route_candidates", "Number of check functions run to route a command", buckets=(0, 1, 2, 4, 8, 16, 32, 64))
+
+coalesced_calls = metrics.counter(
+    "will_coalesced_calls_total", "Plugin calls that shared the response of an identical call in flight", ["plugin"])
+
+phrase_hits = metrics.counter(
+    "will_phrase_hits_total", "Commands dispatched from the phrase table without being parsed", ["plugin"])
+
+_phrase_punctuation = re.compile(r"^[\s.,!?]+|[\s.,!?]+$")
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_phrase(phrase):
+    """
+    Lowercase a phrase, collapse its whitespace, and strip punctuation around it
+
+    :param phrase:
+    :return normalized phrase:
+    """
+    return _whitespace.sub(" ", _phrase_punctuation.sub("", phrase.lower()))
+
+
+def add_phrases(subscription_data, phrases):
+    """
+    Route commands that are exactly one of the phrases to a plugin without parsing them
+
+    :param subscription_data: The plugins subscription
+    :param phrases:
+    """
+    for phrase in phrases:
+        normalized_phrase = normalize_phrase(phrase)
+        existing = phrase_table.get(normalized_phrase)
+        if existing and existing["name"] != subscription_data["name"]:
+            log.warning("Phrase {0} of plugin {1} is already registered by plugin {2}".format(
+                phrase, subscription_data["name"], existing["name"]
+            ))
+            continue
+        phrase_table.update({normalized_phrase: subscription_data})
+
+
+def add_triggers(subscription_data, triggers):
+    """
+    Only run a plugins check function on commands that have one of its trigger values
+
+    :param subscription_data: The plugins subscription
+    :param triggers: Trigger kind (a key of trigger_features) -> list of values
+    """
+    for trigger_kind, values in triggers.items():
+        assert trigger_kind in trigger_features, "Unknown trigger kind {0}".format(trigger_kind)
+        kind_index = trigger_index.setdefault(trigger_kind, {})
+        for value in values:
+            kind_index.setdefault(value.lower(), []).append(subscription_data)
+
+
+def candidates(event):
+    """
+    Look up the plugins whose check functions could match a command in the trigger index
+
+    :param event:
+    :return list of subscriptions, in the order they subscribed:
+    """
+    parsed = event["parsed"]
+    found = dict((id(plugin), plugin) for plugin in untriggered_plugins)
+    for trigger_kind, kind_index in trigger_index.items():
+        for value in trigger_features[trigger_kind](parsed):
+            for plugin in kind_index.get(value, ()):
+                found[id(plugin)] = plugin
+    return sorted(found.values(), key=lambda plugin: plugin["order"])
+
+
+def unmatched_candidates(checked):
+    """
+    :param checked: Subscriptions whose check functions already ran on a command
+    :return list of the check_unmatched subscriptions that weren't checked, in the order they subscribed:
+    """
+    checked_ids = set(id(plugin) for plugin in checked)
+    return [plugin for plugin in unmatched_plugins if id(plugin) not in checked_ids]
+
+
+def match_phrase(command):
+    """
+    :param command:
+    :return (normalized phrase, subscription) if the command is a registered phrase, or (None, None):
+    """
+    normalized_phrase = normalize_phrase(command)
+    subscription_data = phrase_table.get(normalized_phrase)
+    if subscription_data:
+        phrase_hits.inc(plugin=subscription_data["name"])
+        return normalized_phrase, subscription_data
+    return None, None
+
 
 class subscriptions():
     '''
     Manage plugin subscriptions and events
     '''
-    def call_plugin(self, plugin_function, event):
+    def call_plugin(self, plugin_function, event, plugin_name=None, breaker_call=None):
         """
         Call a plugin
 
         :param plugin_function:
         :param event:
+        :param plugin_name: Name used in metrics, defaults to the plugins module name
+        :param breaker_call: Token from the breakers start_call, so an outcome after a timeout isn't recorded
         :return: a response object
         """
         log.debug("Calling function {0} with event data {1}".format(
             plugin_function, event
         ))
+        plugin_name = plugin_name or plugin_function.__module__
         #Call the plugin. If there's a response, return it. If there's not, return "Done"
+        plugin_breaker = breakers.get(plugin_name)
         try:
-            response = plugin_function(event)
+            with plugin_seconds.time(plugin=plugin_name), tracing.span(event, "plugin:{0}".format(plugin_name)):
+                response = plugin_function(event)
             assert type(response) == dict
+            plugin_breaker.record_success(breaker_call)
         except Exception as call_exception:
+            plugin_errors.inc(plugin=plugin_name)
+            plugin_breaker.record_failure(repr(call_exception), breaker_call)
             response = {"type": "error", "text": None, "data": {}}
             exc_type, exc_value, exc_traceback = sys.exc_info()
             user_table = event["user_table"]
@@ -57,29 +224,218 @@ class subscriptions():
         #Send the message
         return response
 
-    def process_event(self, event, db):
+    def run_plugin(self, plugin, event, fallback=True):
+        """
+        Call a subscribed plugin and wait for its response
+
+        :param plugin: The plugins subscription
+        :param event:
+        :param fallback: Whether to use a fallback if the plugin can't answer
+        :return: a response object
+        """
+        return self.submit_plugin(plugin, event, fallback).result()
+
+    def _call_subscribed(self, plugin, event, cache_key=None, breaker_call=None):
+        """
+        Call a subscribed plugin, giving it the full models parse first if it needs one.
+        Commands routed from the phrase table skip it, the plugin answers those without a parse
+
+        :param plugin: The plugins subscription
+        :param event:
+        :param cache_key: Key to cache a successful response under, from cache_key
+        :param breaker_call: Token from the breakers start_call
+        :return: a response object
+        """
+        if plugin.get("needs") and "phrase" not in event:
+            parser.upgrade_event(event)
+        response = self.call_plugin(plugin["function"], event, plugin["name"], breaker_call)
+        if cache_key is not None and response["type"] == "success":
+            cache_policy = plugin["cache"]
+            responses.put(plugin["name"], cache_key, response,
+                          ttl=cache_policy.get("ttl", response_cache.default_ttl),
+                          max_entries=cache_policy.get("max_entries", response_cache.default_max_entries))
+        return response
+
+    def _land(self, flight, plugin_task):
+        """
+        Done callback that stops sharing a finished call
+
+        :param flight: (plugin name, coalesce key)
+        :param plugin_task:
         """
-        Select the right plugin for a command event and run it
+        with in_flight_lock:
+            if in_flight.get(flight) is plugin_task:
+                del in_flight[flight]
+
+    def coalesce_key(self, plugin, event):
+        """
+        :param plugin: The plugins subscription
+        :param event:
+        :return the key of the event from the plugins coalesce function, or None if the call shouldn't be shared:
+        """
+        coalesce_function = plugin.get("coalesce")
+        if not coalesce_function:
+            return None
+        try:
+            return coalesce_function(event)
+        except Exception:
+            log.exception("Coalesce function of plugin {0} raised an exception".format(plugin["name"]))
+            return None
+
+    def cache_key(self, plugin, event):
+        """
+        :param plugin: The plugins subscription
+        :param event:
+        :return the key of the event from the plugins cache policy, or None if the response shouldn't be cached:
+        """
+        cache_policy = plugin.get("cache")
+        if not cache_policy:
+            return None
+        try:
+            return cache_policy["key"](event)
+        except Exception:
+            log.exception("Cache key function of plugin {0} raised an exception".format(plugin["name"]))
+            return None
+
+    def submit_plugin(self, plugin, event, fallback=True):
+        """
+        Queue a subscribed plugin in its lane under its deadline, without waiting for it.
+        If it has a cached response for the event that's used instead of calling it, and if a call with the same
+        coalesce key is already running its response is shared instead of calling it again.
+        If its circuit breaker is open or it times out, it's answered with its fallback
+
+        :param plugin: The plugins subscription
+        :param event:
+        :param fallback: Whether to use a fallback if the plugin can't answer
+        :return Task that finishes with a response object:
+        """
+        plugin_name = plugin["name"]
+        cache_key = self.cache_key(plugin, event)
+        if cache_key is not None:
+            cached = responses.get(plugin_name, cache_key)
+            if cached is not None:
+                log.info("Answering with a cached response of plugin {0}".format(plugin_name))
+                return workers.finished(cached)
+        plugin_breaker = breakers.get(plugin_name)
+        coalesce_key = self.coalesce_key(plugin, event)
+        flight = (plugin_name, coalesce_key)
+        plugin_task = None
+        if coalesce_key is not None:
+            with in_flight_lock:
+                plugin_task = in_flight.get(flight)
+        #A call that's already running got past the breaker, only a new call is checked against it
+        if plugin_task is None and not plugin_breaker.allow():
+            log.warning("Circuit breaker of plugin {0} is open, not calling it".format(plugin_name))
+            unavailable = {"type": "error", "text": "{0} is unavailable right now".format(plugin_name), "data": {}}
+            return self.fallback(plugin, event, unavailable) if fallback else workers.finished(unavailable)
+        if coalesce_key is None:
+            plugin_task, leader = workers.Task(), True
+        else:
+            with in_flight_lock:
+                plugin_task = in_flight.get(flight)
+                leader = plugin_task is None
+                if leader:
+                    plugin_task = workers.Task()
+                    in_flight[flight] = plugin_task
+            if leader:
+                plugin_task.add_done_callback(lambda finished_task: self._land(flight, finished_task))
+            else:
+                log.info("Sharing the in flight call of plugin {0} for key {1}".format(plugin_name, coalesce_key))
+                coalesced_calls.inc(plugin=plugin_name)
+        if leader:
+            #Whichever comes first of the plugins outcome and its deadline is the one the breaker records
+            breaker_call = plugin_breaker.start_call()
+            if plugin_lanes is None:
+                try:
+                    plugin_task.set_result(self._call_subscribed(plugin, event, cache_key, breaker_call))
+                except Exception as call_exception:
+                    plugin_task.set_exception(call_exception)
+                return plugin_task
+            lane_name = plugin.get("lane", lanes.default_lane)
+            plugin_lane = plugin_lanes.get(lane_name) or plugin_lanes[lanes.default_lane]
+            try:
+                lane_task = plugin_lane.submit_for(event["username"], self._call_subscribed, plugin, event, cache_key,
+                                                   breaker_call)
+            except workers.PoolFull:
+                log.warning("Lane {0} is saturated, not calling plugin {1}".format(lane_name, plugin_name))
+                plugin_task.set_result({
+                    "type": "error",
+                    "text": "W.I.L.L is too busy to run {0} right now, try again in a moment".format(plugin_name),
+                    "data": {}
+                })
+                return plugin_task
+            workers.chain(lane_task, plugin_task)
+        if deadlines is None:
+            #A call shared with one running in its callers thread, which has no deadline either
+            return plugin_task
+        response_task = workers.Task()
+        workers.chain(plugin_task, response_task)
+        timeout = plugin.get("timeout", plugin_timeout)
+        def timed_out():
+            '''Answer for the plugin if it hasn't answered by its deadline'''
+            if response_task.done():
+                return
+            log.warning("Plugin {0} didn't respond within {1} seconds".format(plugin_name, timeout))
+            #A shared call only counts against the plugin once
+            if leader:
+                plugin_timeouts.inc(plugin=plugin_name)
+                plugin_breaker.record_failure("Timed out after {0} seconds".format(timeout), breaker_call)
+            timeout_response = {"type": "error", "text": "{0} took too long to respond".format(plugin_name), "data": {}}
+            if fallback:
+                workers.chain(self.fallback(plugin, event, timeout_response), response_task)
+            else:
+                response_task.set_result(timeout_response)
+        deadlines.add(timeout, timed_out)
+        return response_task
+
+    def fallback(self, plugin, event, response):
+        """
+        Answer for a plugin that's unavailable, with its fallback function, then the users default plugin,
+        then the response given
+
+        :param plugin: The plugins subscription
+        :param event:
+        :param response: The response to use if there's no fallback
+        :return Task that finishes with a response object:
+        """
+        plugin_fallbacks.inc(plugin=plugin["name"])
+        if "fallback" in plugin:
+            return workers.finished(
+                self.call_plugin(plugin["fallback"], event, "{0}:fallback".format(plugin["name"])))
+        default_subscription = plugins_by_name.get(event["user_table"]["default_plugin"])
+        if default_subscription and default_subscription is not plugin:
+            log.info("Falling back from plugin {0} to default plugin {1}".format(
+                plugin["name"], default_subscription["name"]))
+            return self.submit_plugin(default_subscription, event, fallback=False)
+        return workers.finished(response)
+
+    def process_event(self, event, db, plugin=None):
+        """
+        Select the right plugin for a command event and queue it.
+        Routing happens in the callers thread, the plugin runs in its lane
 
         :param event:
         :param db:
-        :return a response object:
+        :param plugin: The subscription of a plugin already matched to the command, skips the check functions
+        :return Task that finishes with a response object:
         """
         user_data = db["users"]
-        time.sleep(0.1)
         log.debug("Processing event {0}".format(event))
         #If the queue is empty, pass
-        assert type(event) == dict
+        assert isinstance(event, dict)
         event.update(dict(db=db))
         event_command = event["command"]
         log.debug("Event session is {0}".format(event["session"]))
         username = event["session"]["username"]
         log.info("Processing event with command {0}, user {1}".format(
             event_command, username))
-        user_table = user_data.find_one(username=username)
+        with db_seconds.time(operation="find_user"), tracing.span(event, "db:find_user"):
+            user_table = user_data.find_one(username=username)
         event.update({"user_table":user_table})
         event.update({"username":username})
-        found_plugins = []
+        if plugin:
+            log.info("Running plugin {0} matched before parsing".format(plugin["name"]))
+            return self.submit_plugin(plugin, event)
         default_plugin_name = user_table["default_plugin"]
         def plugin_check(plugin):
             '''Run the plugins check function to see if it's true'''
@@ -87,22 +443,31 @@ class subscriptions():
             check_function = plugin["check"]
             log.debug("Running check_function {0} on plugin {1}".format(
                 check_function, plugin))
-            if check_function(event):
+            with tracing.span(event, "check:{0}".format(plugin["name"])):
+                if plugin.get("check_needs"):
+                    parser.upgrade_event(event)
+                matched = check_function(event)
+            if matched:
                 log.info("Plugin {0} matches command {1}".format(
                     plugin, event_command
                 ))
-                if plugin["name"] != default_plugin_name:
-                    found_plugins.append(plugin)
-        #Map the subscribed plugins to the function that runs their check functions
-        list(map(plugin_check, plugin_subscriptions))
+            return matched
+        #Run the check functions of the plugins the trigger index picked out
+        with tracing.span(event, "routing"):
+            plugin_candidates = candidates(event)
+            route_candidates.observe(len(plugin_candidates))
+            if checks:
+                matched_plugins = checks.run(plugin_candidates, plugin_check)
+            else:
+                matched_plugins = [plugin for plugin in plugin_candidates if plugin_check(plugin)]
+        found_plugins = [plugin for plugin in matched_plugins if plugin["name"] != default_plugin_name]
         #How many plugins match the command data
         plugin_len = len(found_plugins)
         if plugin_len == 1:
             plugin = found_plugins[0]
             log.info("Running plugin {0}".format(plugin))
-            plugin_function = plugin['function']
             #Call the plugin
-            return self.call_plugin(plugin_function,event)
+            return self.submit_plugin(plugin, event)
         elif plugin_len > 1:
             #Ask the user which one they want to run
             plugin_names = {}
@@ -116,23 +481,78 @@ class subscriptions():
             #TODO: integrate the response framework
             interface.check_plugins(plugin_names,event)
         else:
+            #Plugins whose triggers only pick out their likely commands get a second look before the default plugin
+            late_candidates = [plugin for plugin in unmatched_candidates(plugin_candidates)
+                               if plugin["name"] != default_plugin_name]
+            if late_candidates:
+                with tracing.span(event, "routing:unmatched"):
+                    if checks:
+                        late_matches = checks.run(late_candidates, plugin_check)
+                    else:
+                        late_matches = [plugin for plugin in late_candidates if plugin_check(plugin)]
+                if late_matches:
+                    log.info("Running plugin {0}, matched outside its triggers".format(late_matches[0]["name"]))
+                    return self.submit_plugin(late_matches[0], event)
             default_plugin = user_table["default_plugin"]
-            #I wish I had a more efficient way to do this
-            default_plugin_func = None
-            for i in plugin_subscriptions:
-                if i["name"] == default_plugin:
-                    default_plugin_func = i["function"]
-                    break
-            if default_plugin_func:
+            default_subscription = plugins_by_name.get(default_plugin)
+            if default_subscription:
                 #Call the default plugin
-                return self.call_plugin(default_plugin_func, event)
+                return self.submit_plugin(default_subscription, event)
             else:
                 error_message = "Couldn't find defafult plugin {0} in plugin list {1}".format(
                     default_plugin, plugin_subscriptions
                 )
                 #Send the error message to the user
                 log.error(error_message)
-                return {"type": "error", "text":error_message, "data": {}}
+                return workers.finished({"type": "error", "text":error_message, "data": {}})
+
+def start_lanes(lane_workers=None, queue_depth=lanes.default_queue_depth, user_depth=lanes.default_user_depth,
+                timeout=default_plugin_timeout, failure_threshold=breaker.default_failure_threshold,
+                reset_seconds=breaker.default_reset_seconds):
+    """
+    Run plugins in lanes so fast plugins don't queue behind slow ones and each can be given a deadline,
+    and set up their circuit breakers
+
+    :param lane_workers: Lane name -> number of workers
+    :param queue_depth: Number of calls that can wait in each lane
+    :param user_depth: Number of calls one user can have waiting in a lane
+    :param timeout: Default seconds a plugin can run
+    :param failure_threshold: Errors or timeouts in a row that open a plugins breaker
+    :param reset_seconds: Seconds a breaker stays open
+    """
+    global plugin_lanes, plugin_timeout, breakers, deadlines
+    plugin_timeout = timeout
+    if deadlines is None:
+        deadlines = workers.Deadlines("plugin-deadlines")
+    breakers = breaker.BreakerRegistry(failure_threshold, reset_seconds)
+    plugin_lanes = lanes.start_lanes(lane_workers, queue_depth, user_depth)
+    for plugin in plugin_subscriptions:
+        if plugin.get("lane", lanes.default_lane) not in plugin_lanes:
+            log.warning("Plugin {0} is in unknown lane {1}, it will run in lane {2}".format(
+                plugin["name"], plugin["lane"], lanes.default_lane))
+
+def lane_states():
+    """
+    :return list of lane dictionaries, sorted by lane name:
+    """
+    if plugin_lanes is None:
+        return []
+    return [plugin_lanes[lane_name].to_dict() for lane_name in sorted(plugin_lanes)]
+
+def start_check_runner(worker_num=check_runner.default_workers, queue_depth=check_runner.default_queue_depth,
+                       timeout=check_runner.default_timeout, demote_after=check_runner.default_demote_after,
+                       demote_seconds=check_runner.default_demote_seconds):
+    """
+    Run check functions concurrently with a routing deadline
+
+    :param worker_num:
+    :param queue_depth:
+    :param timeout:
+    :param demote_after:
+    :param demote_seconds:
+    """
+    global checks
+    checks = check_runner.CheckRunner(worker_num, queue_depth, timeout, demote_after, demote_seconds)
 
 def process_plugins(path):
     """
@@ -152,7 +572,18 @@ def subscribe(subscription_data):
     """
     Provides a decorator for subscribing plugin to commands
 
-    :param subscription_data: A dict containing the name and check function
+    :param subscription_data: A dict containing the name and check function. Optionally, a list of phrases
+    that are routed to the plugin without parsing, and needs and check_needs lists like ["vectors", "ents"] if the
+    plugin or its check function need the full model. lane is the lane the plugin runs in, "fast" for plugins that
+    answer right away and "slow" for ones that wait on the network. timeout overrides the default plugin deadline,
+    and fallback is a function called with the event when the plugin is unavailable. cache is a policy like
+    {"key": function, "ttl": seconds, "max_entries": number} to reuse successful responses, where the key function
+    is called with the event before the full model parses it and returns None for commands that shouldn't be cached.
+    coalesce is a function like the cache key function, concurrent calls it gives the same key share one response.
+    triggers maps kinds in trigger_features to values, the check function is only run on commands with one of them.
+    Plugins without triggers are checked on every command, and check_unmatched runs a triggered plugins check function
+    on commands no plugin matched too, for triggers that only pick out its likely commands. prepare is a function called with the full models parse
+    function once it's loaded, for plugins that precompute something from the model their check function uses
     """
     assert(type(subscription_data) == dict)
     def wrap(f):
@@ -165,10 +596,31 @@ def subscribe(subscription_data):
             'function': f
         })
         log.info("Appending subscription data {0} to plugin subscriptions".format(subscription_data))
+        subscription_data.update({"order": len(plugin_subscriptions)})
         plugin_subscriptions.append(subscription_data)
+        plugins_by_name.update({subscription_data["name"]: subscription_data})
+        if "triggers" in subscription_data:
+            add_triggers(subscription_data, subscription_data["triggers"])
+            if subscription_data.get("check_unmatched"):
+                unmatched_plugins.append(subscription_data)
+        else:
+            untriggered_plugins.append(subscription_data)
+        if "phrases" in subscription_data:
+            add_phrases(subscription_data, subscription_data["phrases"])
         return f
     return wrap
 
+def prepare_plugins(parse_function):
+    """
+    Call the prepare function of every plugin that has one
+
+    :param parse_function: Function that parses a text with the model check functions that need vectors get
+    """
+    for plugin in plugin_subscriptions:
+        if "prepare" in plugin:
+            log.info("Preparing plugin {0}".format(plugin["name"]))
+            plugin["prepare"](parse_function)
+
 def load(dir_path, DB):
     """
     Run the plugin loader on processed plugins
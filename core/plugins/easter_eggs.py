@@ -1,5 +1,14 @@
-from core.plugin_handler import subscribe
+#Internal imports
+from core.plugin_handler import subscribe, normalize_phrase
+import core.parser as parser
+
+#External imports
+import numpy
+
+#Builtin imports
 import logging
+import re
+import threading
 
 log = logging.getLogger()
 
@@ -16,19 +25,82 @@ easter_eggs = {
     "Who is your master?": "I was created by Will Beddow (will@willbeddow.com)"
 }
 
+#Normalized phrase -> response, for commands routed from the phrase table
+phrase_responses = dict((normalize_phrase(phrase), response) for phrase, response in easter_eggs.items())
+
+#Cosine similarity a command needs with a phrase to activate it
+threshold = 0.96
+
+egg_phrases = list(easter_eggs)
+
+#Commands close enough to a phrase usually start with the same word, so those are checked first.
+#Commands starting with another word are checked if no other plugin matched them
+egg_first_words = sorted(set(re.match(r"\w+", phrase).group().lower() for phrase in egg_phrases))
+
+#Unit length phrase vectors, one row per phrase in egg_phrases. Set by prepare with the model commands are scored with
+egg_matrix = None
+egg_matrix_lock = threading.Lock()
+
+def phrase_matrix(parse_function):
+    """
+    Parse the phrases and build a matrix of their unit length vectors
+
+    :param parse_function: Function that parses a text into a document with a vector
+    :return numpy matrix:
+    """
+    vectors = numpy.array([parse_function(phrase).vector for phrase in egg_phrases], dtype=numpy.float32)
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors/norms
+
+def prepare(parse_function):
+    """
+    Build the phrase matrix with the model the check function scores commands with,
+    so both sides come from the same vector space
+
+    :param parse_function:
+    :return numpy matrix:
+    """
+    global egg_matrix
+    with egg_matrix_lock:
+        egg_matrix = phrase_matrix(parse_function)
+        log.info("Built easter egg matrix for {0} phrases".format(len(egg_phrases)))
+    return egg_matrix
+
+def best_egg(event):
+    """
+    Score the command against every phrase with one matrix-vector product
+
+    :param event:
+    :return (similarity, phrase) of the closest phrase:
+    """
+    command_vector = event["parsed"].vector
+    command_norm = numpy.linalg.norm(command_vector) if command_vector is not None else 0
+    if not command_norm:
+        return 0.0, None
+    matrix = egg_matrix if egg_matrix is not None else prepare(parser.parse_full)
+    scores = matrix.dot(numpy.asarray(command_vector, dtype=numpy.float32)/command_norm)
+    best_index = int(scores.argmax())
+    return float(scores[best_index]), egg_phrases[best_index]
+
 def egg_hunt(event):
-    scores = [event["doc"].similarity(event["parse"](x)) for x in easter_eggs]
-    return max(scores) >= 0.96
+    similarity, phrase = best_egg(event)
+    if similarity >= threshold:
+        #Keep the match for the plugin so it doesn't have to score the command again
+        event.update({"easter_egg": phrase})
+        return True
+    return False
 
-@subscribe({"name": "easter_eggs", "check": egg_hunt})
+@subscribe({"name": "easter_eggs", "check": egg_hunt, "phrases": egg_phrases, "lane": "fast",
+            "check_needs": ["vectors"], "prepare": prepare, "triggers": {"first_words": egg_first_words},
+            "check_unmatched": True})
 def egg(event):
-    scores = {}
-    for x in easter_eggs:
-        x_parse = event["parse"](x)
-        scores.update({
-            event["doc"].similarity(x_parse): easter_eggs[x]
-        })
-    most_compatible = scores[max(scores)]
+    if event.get("phrase") in phrase_responses:
+        return {"type": "success", "text": phrase_responses[event["phrase"]], "data": {}}
+    phrase = event.get("easter_egg") or best_egg(event)[1]
+    if not phrase:
+        return {"type": "error", "text": "Couldn't match {0} to an easter egg".format(event["command"]), "data": {}}
+    most_compatible = easter_eggs[phrase]
     log.debug("Query {0} activated easter egg {1}".format(event["command"], most_compatible))
     response = {"type": "success", "text": most_compatible, "data": {}}
     return response
@@ -1,27 +1,30 @@
 #Internal imports
 from core.plugin_handler import subscribe
+import core.parser as parser
+import core.title_index as title_index
 import tools
 
 #Builtin imports
 import logging
-import json
-import difflib
+import os
 
-shows = json.loads(open("core/plugin_files/shows.json").read())
 log = logging.getLogger()
 
+#Built with python -m core.title_index core/plugin_files/shows.json core/plugin_files/shows, passing the
+#configured models with --model and --full-model. Queries are embedded with the full model
+shows_index = title_index.TitleIndex(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "plugin_files", "shows"),
+    model=parser.full_model_label())
+
 def is_netflix(event):
-    event_doc = event["doc"]
-    return "netflix" in [word.orth_.lower() for word in event_doc]
+    return "netflix" in event["parsed"].words
 
-@subscribe({"name": "netflix", "check":  is_netflix})
+@subscribe({"name": "netflix", "check":  is_netflix, "needs": ["vectors"], "lane": "slow",
+            "triggers": {"words": ["netflix"]}})
 def main(event):
-    event_doc = event["doc"]
-    work = None
-    for chunk in event_doc.noun_chunks:
-        #Use dependency parsing to dermine the object of the command
-        if chunk.root.dep_ == "dobj" or chunk.root.dep_ == "pobj":
-            work = chunk.text
+    #Use dependency parsing to dermine the object of the command
+    objects = event["parsed"].chunks_with_dep("dobj", "pobj")
+    work = objects[-1] if objects else None
     if not work:
         return {
             "type": "error",
@@ -29,20 +32,35 @@ def main(event):
             "data": {}
         }
     log.debug("In netflix module, found work {0}".format(work))
-    #Find the show in a json file keyed with show names and that has show ids
-    sims = {}
-    log.debug("Parsing shows for work {0}".format(work))
-    work_parsed = event["parse"](work)
-    for show in shows:
-        show_parsed = event["parse"](show)
-        show_sim = work_parsed.similarity(show_parsed)
-        show_id = shows[show]
-        sims.update({show_sim: [show, show_id]})
-    max_sim = max(sims.keys())
-    most_similar = sims[max_sim]
-    log.debug(most_similar)
-    show_name = most_similar[0]
-    show_id = most_similar[1]
+    #Find the show in the title index, by its title if it's close enough and by vector similarity if it's not
+    try:
+        exact_match = shows_index.exact(work)
+    except IOError:
+        log.exception("Couldn't load the Netflix title index {0}".format(shows_index.prefix))
+        return {
+            "type": "error",
+            "text": "The Netflix title index hasn't been built. An administrator can build it with "
+                    "python -m core.title_index",
+            "data": {}
+        }
+    except title_index.ModelMismatch as mismatch:
+        log.error(str(mismatch))
+        return {
+            "type": "error",
+            "text": "The Netflix title index was built with a different model than W.I.L.L is using. An administrator "
+                    "can rebuild it with python -m core.title_index",
+            "data": {}
+        }
+    if exact_match:
+        max_sim = 1.0
+        show_name, show_id = exact_match
+    else:
+        log.debug("Searching shows for work {0}".format(work))
+        closest_shows = shows_index.search(event["parse"](work).vector, k=1)
+        if closest_shows:
+            max_sim, show_name, show_id = closest_shows[0]
+        else:
+            max_sim, show_name, show_id = 0.0, None, None
     log.info("Found {0} with similarity {1} and id {2}".format(show_name, max_sim, show_id))
     if not show_name:
         return {
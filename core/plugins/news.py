@@ -6,16 +6,22 @@ import newspaper
 #Builtin imports
 import logging
 import threading
-import time
 
 log = logging.getLogger()
 
+#Seconds the news of a site is reused for
+news_ttl = 43200
+
 def is_news(event):
     '''Determine whether to read the news'''
-    event_words = [token.orth_.lower() for token in event["doc"]]
-    return "news" in event_words
+    return "news" in event["parsed"].words
+
+def news_site(event):
+    '''Cache and coalesce key, the same news is read to every user of a site'''
+    return event["user_table"]["news_site"]
 
-@subscribe({"name": "news", "check": is_news})
+@subscribe({"name": "news", "check": is_news, "lane": "slow", "triggers": {"words": ["news"]},
+            "cache": {"key": news_site, "ttl": news_ttl, "max_entries": 64}, "coalesce": news_site})
 def news_reader(event):
     '''Use the excellent newspaper module to fetch the news from the readers favorite site'''
     response = {"type": "success", "text": None, "data": {}}
@@ -23,16 +29,6 @@ def news_reader(event):
     event_user = event['username']
     user_table = db['users'].find_one(username=event_user)
     user_news_site = user_table["news_site"]
-    news_table = db["news"]
-    cached_sites = [list(site.values())[0] for site in db.query("SELECT site from `news`")]
-    log.debug("Cached sites are {0}".format(cached_sites))
-    if user_news_site in cached_sites:
-        site_row = news_table.find_one(site=user_news_site)
-        site_time = site_row["time"]
-        if time.time()<site_time+43200:
-            log.info("Using cached news for site {0}".format(user_news_site))
-            news_str = site_row["news_str"]
-            response["text"] = news_str
     log.info("Parsing news site {0} for user {1}".format(user_news_site, event_user))
     site_object = newspaper.build(user_news_site, memoize_articles=False)
     log.debug("Finished building newspaper object")
@@ -66,6 +62,5 @@ def news_reader(event):
     log.debug("Compiling article output {0} into string".format(output_strs))
     output_str = '\n'.join(output_strs)
     log.debug("Returning output string {0}".format(output_str))
-    db["news"].upsert(dict(site=user_news_site,time=time.time(),news_str=output_str), ['site'])
     response["text"] = output_str
     return response
\ No newline at end of file
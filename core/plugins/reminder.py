@@ -27,7 +27,8 @@ def is_reminder(event):
     else:
         return False
 
-@subscribe({"name": "reminder", "check": is_reminder})
+@subscribe({"name": "reminder", "check": is_reminder, "needs": ["ents"], "lane": "fast",
+            "triggers": {"verbs": ["remind"], "words": ["reminder"]}})
 def main(event):
     '''Set a reminder using the interface scheduler'''
     response = {"type": "success", "text": None, "data": {}}
@@ -12,6 +12,7 @@ import requests
 
 # Builtin imports
 import logging
+import re
 
 log = logging.getLogger()
 
@@ -86,28 +87,44 @@ def search_wolfram(query, api_key):
         return False
 
 
+question_words = [
+    "what",
+    "when",
+    "why",
+    "how",
+    "who",
+    "are",
+    "is"
+]
+
 def is_search(event):
     '''Determine whether it's a search command'''
-    command = event["command"]
     if "search" in event["verbs"]:
         return True
-    question_words = [
-        "what",
-        "when",
-        "why",
-        "how",
-        "who",
-        "are",
-        "is"
-    ]
-    first_word = command.split(" ")[0].lower()
+    first_word = event["parsed"].first_word
     log.debug("First word in command is {0}".format(first_word))
     if first_word in question_words:
         return True
     return False
 
 
-@subscribe({"name": "search", "check": is_search})
+#Queries with one of these words have answers that change with the time they're asked, so they aren't cached
+time_words = frozenset([
+    "now", "today", "tonight", "tomorrow", "yesterday", "current", "currently", "latest",
+    "time", "day", "date", "week", "month", "year"
+])
+
+def search_query(event):
+    '''Cache and coalesce key, the query with its case and whitespace normalized'''
+    query_words = re.findall(r"[\w']+", event["command"].lower())
+    if time_words.intersection(query_words):
+        return None
+    return " ".join(query_words)
+
+
+@subscribe({"name": "search", "check": is_search, "lane": "slow",
+            "triggers": {"verbs": ["search"], "first_words": question_words},
+            "cache": {"key": search_query, "ttl": 600, "max_entries": 512}, "coalesce": search_query})
 def main(data):
     '''Start the search'''
     response = {"text": None, "data":{}, "type": "success"}
@@ -12,17 +12,19 @@ sp = spotipy.Spotify()
 log = logging.getLogger()
 
 def is_spotify(event):
-    event_doc = event["doc"]
-    return "spotify" in [word.orth_.lower() for word in event_doc]
+    return "spotify" in event["parsed"].words
 
-@subscribe({"name": "spotify", "check":  is_spotify})
+def spotify_work(event):
+    '''Cache and coalesce key, the song asked for'''
+    objects = event["parsed"].chunks_with_dep("dobj")
+    return objects[-1].lower() if objects else None
+
+@subscribe({"name": "spotify", "check":  is_spotify, "lane": "slow", "triggers": {"words": ["spotify"]},
+            "cache": {"key": spotify_work, "ttl": 86400, "max_entries": 1024}, "coalesce": spotify_work})
 def main(event):
-    event_doc = event["doc"]
-    work = None
-    for chunk in event_doc.noun_chunks:
-        #Use dependency parsing to dermine the object of the command
-        if chunk.root.dep_ == "dobj":
-            work = chunk.text
+    #Use dependency parsing to dermine the object of the command
+    objects = event["parsed"].chunks_with_dep("dobj")
+    work = objects[-1] if objects else None
     if not work:
         return {
             "type": "error",
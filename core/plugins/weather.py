@@ -14,8 +14,7 @@ log = logging.getLogger()
 
 def is_weather(event):
     '''Determine whether to read the news'''
-    event_words = [token.orth_.lower() for token in event["doc"]]
-    return "weather" in event_words
+    return "weather" in event["parsed"].words
 
 def set_country(response_value, event):
     """
@@ -102,7 +101,18 @@ def ask_country(response_value, event):
         response["text"] = "City {0} failed string validation".format(response_value)
     return response
 
-@subscribe({"name": "weather", "check": is_weather})
+def weather_place(event):
+    '''
+    Cache and coalesce key, the users place and temperature unit.
+    Users without a place aren't cached, they get asked for it
+    '''
+    user_table = event["user_table"]
+    if not (user_table["city"] and user_table["country"]):
+        return None
+    return (user_table["city"], user_table["state"], user_table["country"], user_table.get("temp_unit"))
+
+@subscribe({"name": "weather", "check": is_weather, "lane": "slow", "triggers": {"words": ["weather"]},
+            "cache": {"key": weather_place, "ttl": 600, "max_entries": 1024}, "coalesce": weather_place})
 def weather_main(event):
     '''Get the users weather from the infromation in the users database'''
     log.info("This function is {0}".format(weather_main))
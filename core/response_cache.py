@@ -0,0 +1,107 @@
+#Builtin imports
+import collections
+import logging
+import threading
+import time
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+#Seconds a cached response is used for, unless the plugins cache policy has a ttl
+default_ttl = 300
+
+#Responses kept for each plugin, unless the plugins cache policy has max_entries
+default_max_entries = 256
+
+response_cache_lookups = metrics.counter(
+    "will_response_cache_total", "Plugin response cache lookups, by plugin and result", ["plugin", "result"])
+
+
+class ResponseCache:
+    '''
+    Least recently used cache of plugin responses, with a bounded section for each plugin.
+    Plugins opt in with a cache policy in their subscription:
+    {"key": function(event) -> hashable key or None to skip the cache, "ttl": seconds, "max_entries": number}
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        #Plugin name -> OrderedDict of key -> (expiry time, response), least recently used first
+        self._sections = {}
+        #Plugin name -> {"hit", "miss", "expired"} lookup counts
+        self._counts = {}
+
+    def _count(self, plugin_name, result):
+        """
+        :param plugin_name:
+        :param result: hit, miss, or expired
+        """
+        response_cache_lookups.inc(plugin=plugin_name, result=result)
+        plugin_counts = self._counts.setdefault(plugin_name, {"hit": 0, "miss": 0, "expired": 0})
+        plugin_counts[result] += 1
+
+    def get(self, plugin_name, key):
+        """
+        :param plugin_name:
+        :param key: The key from the plugins key function
+        :return the cached response, or None:
+        """
+        with self._lock:
+            section = self._sections.get(plugin_name)
+            entry = section.get(key) if section is not None else None
+            if entry is None:
+                self._count(plugin_name, "miss")
+                return None
+            expires, response = entry
+            if expires <= time.time():
+                del section[key]
+                self._count(plugin_name, "expired")
+                return None
+            #Move it to the most recently used end
+            del section[key]
+            section[key] = entry
+            self._count(plugin_name, "hit")
+            return response
+
+    def put(self, plugin_name, key, response, ttl=default_ttl, max_entries=default_max_entries):
+        """
+        :param plugin_name:
+        :param key:
+        :param response:
+        :param ttl: Seconds the response is used for
+        :param max_entries: Responses kept for the plugin, the least recently used is evicted past it
+        """
+        with self._lock:
+            section = self._sections.setdefault(plugin_name, collections.OrderedDict())
+            section.pop(key, None)
+            section[key] = (time.time()+ttl, response)
+            while len(section) > max_entries:
+                section.popitem(last=False)
+
+    def clear(self, plugin_name=None):
+        """
+        :param plugin_name: Plugin to clear the responses of, or None to clear every plugin
+        """
+        with self._lock:
+            if plugin_name is None:
+                self._sections.clear()
+            else:
+                self._sections.pop(plugin_name, None)
+
+    def stats(self):
+        """
+        :return list of dictionaries with the entries, lookups and hit rate of each plugin, sorted by plugin name:
+        """
+        with self._lock:
+            plugin_stats = []
+            for plugin_name in sorted(set(self._counts) | set(self._sections)):
+                plugin_counts = self._counts.get(plugin_name, {"hit": 0, "miss": 0, "expired": 0})
+                lookups = sum(plugin_counts.values())
+                plugin_stats.append(dict(
+                    plugin_counts,
+                    plugin=plugin_name,
+                    entries=len(self._sections.get(plugin_name, ())),
+                    hit_rate=round(plugin_counts["hit"]/float(lookups), 3) if lookups else None
+                ))
+            return plugin_stats
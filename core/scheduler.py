@@ -0,0 +1,142 @@
+#Builtin imports
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+log = logging.getLogger()
+
+
+class EventScheduler:
+    '''
+    A min-heap of pending events keyed on event["time"].
+    Events are keyed by their uid, so inserting an event with a uid that's already pending replaces it.
+    Cancelled events are left in the heap and skipped when they reach the top.
+    If a journal is set, inserts and completions are recorded in it while the lock is held,
+    so the journal has them in the order they happened
+    '''
+    def __init__(self, journal=None):
+        self._heap = []
+        #uid -> (sequence number of the live heap entry, event)
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self.journal = journal
+
+    def insert(self, event, record=True):
+        """
+        Schedule an event, waking the monitor if it's now the next one due
+
+        :param event: An event object with a time and a uid
+        :param record: Whether to write the insert to the journal
+        """
+        uid = event["uid"]
+        sequence = next(self._sequence)
+        with self._condition:
+            self._entries[uid] = (sequence, event)
+            heapq.heappush(self._heap, (event["time"], sequence, uid))
+            if self._heap[0][1] == sequence:
+                self._condition.notify_all()
+            self._compact()
+            if record and self.journal:
+                self.journal.record_insert(event)
+
+    def append(self, event):
+        """
+        Alias for insert so plugins can keep using core.events.append
+
+        :param event:
+        """
+        self.insert(event)
+
+    def cancel(self, uid):
+        """
+        Cancel a pending event
+
+        :param uid:
+        :return the cancelled event, or None if it wasn't pending:
+        """
+        with self._condition:
+            entry = self._entries.pop(uid, None)
+            if not entry:
+                return None
+            self._compact()
+            if self.journal:
+                self.journal.record_done(entry[1])
+        return entry[1]
+
+    def remove(self, event):
+        """
+        Cancel a pending event by its object
+
+        :param event:
+        """
+        self.cancel(event["uid"])
+
+    def wait_next(self, timeout=None):
+        """
+        Block until the earliest event is due, then pop it
+
+        :param timeout: Seconds to wait before giving up, or None to wait forever
+        :return the due event, or None on timeout:
+        """
+        give_up = None if timeout is None else time.time()+timeout
+        return self._pop_due(give_up)
+
+    def _pop_due(self, give_up):
+        """
+        :param give_up: Epoch time to stop waiting at, or None
+        :return the due event, or None if give_up passed:
+        """
+        with self._condition:
+            while True:
+                self._discard_cancelled()
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    event_time, sequence, uid = heapq.heappop(self._heap)
+                    event = self._entries.pop(uid)[1]
+                    if self.journal:
+                        self.journal.record_done(event)
+                    return event
+                wake_time = self._heap[0][0] if self._heap else None
+                if give_up is not None:
+                    if now >= give_up:
+                        return None
+                    wake_time = give_up if wake_time is None else min(wake_time, give_up)
+                if wake_time is None:
+                    self._condition.wait()
+                else:
+                    self._condition.wait(wake_time-now)
+
+    def _is_live(self, heap_entry):
+        """
+        :param heap_entry:
+        :return boolean, whether the heap entry still belongs to a pending event:
+        """
+        entry = self._entries.get(heap_entry[2])
+        return entry is not None and entry[0] == heap_entry[1]
+
+    def _discard_cancelled(self):
+        '''Pop cancelled or replaced entries off the top of the heap'''
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        '''Rebuild the heap once more than half of it is dead entries'''
+        if len(self._heap) > 64 and len(self._heap) > 2*len(self._entries):
+            self._heap = [heap_entry for heap_entry in self._heap if self._is_live(heap_entry)]
+            heapq.heapify(self._heap)
+
+    def __iter__(self):
+        with self._condition:
+            pending = [entry[1] for entry in self._entries.values()]
+        return iter(pending)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    __nonzero__ = __bool__
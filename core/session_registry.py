@@ -0,0 +1,203 @@
+#Builtin imports
+import datetime
+import logging
+import threading
+import time
+
+log = logging.getLogger()
+
+#Seconds a session can go without a command before it's ended
+default_idle_ttl = 21600
+
+#Seconds a session can live regardless of activity
+default_max_age = 604800
+
+#Seconds a response listener set with tools.set_response stays valid
+default_response_ttl = 600
+
+#Number of commands kept in each sessions history
+default_history = 50
+
+default_reap_interval = 60
+
+
+class SessionRegistry(dict):
+    '''
+    The session_id -> session dictionary, with a username -> set(session_id) index kept in sync
+    so a users sessions can be found without scanning every session
+    '''
+    def __init__(self):
+        dict.__init__(self)
+        self._by_user = {}
+        self._lock = threading.RLock()
+
+    def _index(self, session_id, session_data):
+        """
+        :param session_id:
+        :param session_data:
+        """
+        self._by_user.setdefault(session_data["username"], set()).add(session_id)
+
+    def _unindex(self, session_id, session_data):
+        """
+        :param session_id:
+        :param session_data:
+        """
+        username = session_data["username"]
+        user_sessions = self._by_user.get(username)
+        if user_sessions is not None:
+            user_sessions.discard(session_id)
+            if not user_sessions:
+                del self._by_user[username]
+
+    def __setitem__(self, session_id, session_data):
+        with self._lock:
+            if dict.__contains__(self, session_id):
+                self._unindex(session_id, dict.__getitem__(self, session_id))
+            dict.__setitem__(self, session_id, session_data)
+            self._index(session_id, session_data)
+
+    def __delitem__(self, session_id):
+        with self._lock:
+            session_data = dict.__getitem__(self, session_id)
+            dict.__delitem__(self, session_id)
+            self._unindex(session_id, session_data)
+
+    def update(self, *args, **kwargs):
+        for session_id, session_data in dict(*args, **kwargs).items():
+            self[session_id] = session_data
+
+    def pop(self, session_id, *default):
+        with self._lock:
+            if dict.__contains__(self, session_id):
+                session_data = dict.__getitem__(self, session_id)
+                del self[session_id]
+                return session_data
+        if default:
+            return default[0]
+        raise KeyError(session_id)
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._by_user.clear()
+
+    def add(self, session_data):
+        """
+        Register a session under its id
+
+        :param session_data: A session object with an id and a username
+        """
+        self[session_data["id"]] = session_data
+
+    def remove(self, session_id):
+        """
+        :param session_id:
+        :return the removed session, or None if it wasn't registered:
+        """
+        return self.pop(session_id, None)
+
+    def session_ids(self, username):
+        """
+        :param username:
+        :return set of the users session ids:
+        """
+        with self._lock:
+            return set(self._by_user.get(username, ()))
+
+    def for_user(self, username):
+        """
+        :param username:
+        :return list of the users sessions:
+        """
+        with self._lock:
+            return [dict.__getitem__(self, session_id) for session_id in self._by_user.get(username, ())]
+
+    def users(self):
+        """
+        :return list of usernames with an active session:
+        """
+        with self._lock:
+            return list(self._by_user.keys())
+
+    def user_count(self):
+        """
+        :return number of users with an active session:
+        """
+        return len(self._by_user)
+
+    def session_count(self):
+        """
+        :return number of active sessions:
+        """
+        return len(self)
+
+    def touch(self, session_id):
+        """
+        Mark a session as active
+
+        :param session_id:
+        """
+        session_data = self.get(session_id)
+        if session_data:
+            session_data["last_active"] = time.time()
+
+
+class SessionReaper:
+    '''
+    Background thread that ends idle and expired sessions and drops stale response listeners
+    '''
+    def __init__(self, sessions, end_function, idle_ttl=default_idle_ttl, max_age=default_max_age,
+                 interval=default_reap_interval):
+        """
+        :param sessions: SessionRegistry
+        :param end_function: Called with the id of each session that should be ended
+        :param idle_ttl:
+        :param max_age:
+        :param interval: Seconds between passes
+        """
+        self.sessions = sessions
+        self.end_function = end_function
+        self.idle_ttl = idle_ttl
+        self.max_age = max_age
+        self.interval = interval
+
+    def reap(self):
+        """
+        Run one pass over the sessions
+
+        :return number of sessions ended:
+        """
+        current_time = time.time()
+        oldest_created = datetime.datetime.now()-datetime.timedelta(seconds=self.max_age)
+        expired = []
+        for session_id, session_data in list(self.sessions.items()):
+            last_active = session_data.get("last_active", current_time)
+            if current_time-last_active > self.idle_ttl or session_data["created"] < oldest_created:
+                expired.append(session_id)
+                continue
+            for command_obj in list(session_data["commands"]):
+                if command_obj.get("response_expires", current_time) < current_time:
+                    #Release the event (and its parsed doc) held by the listener
+                    command_obj.pop("function", None)
+                    command_obj.pop("event", None)
+                    command_obj.pop("response_expires", None)
+        for session_id in expired:
+            log.info(":{0}:Ending expired session".format(session_id))
+            self.end_function(session_id)
+        return len(expired)
+
+    def _reap_loop(self):
+        '''Reaper thread'''
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reap()
+            except Exception:
+                log.exception("Error while reaping sessions")
+
+    def start(self):
+        '''Start the reaper thread'''
+        reaper_thread = threading.Thread(target=self._reap_loop, name="session-reaper")
+        reaper_thread.daemon = True
+        reaper_thread.start()
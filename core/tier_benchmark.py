@@ -0,0 +1,170 @@
+#Builtin imports
+import argparse
+import json
+import logging
+import time
+
+#External imports
+import spacy
+
+#Internal imports
+import core.parse_result as parse_result
+import core.plugin_handler as plugin_handler
+
+log = logging.getLogger()
+
+#Commands benchmarked when no command file is given
+default_commands = [
+    "What's the weather like today?",
+    "Read me the news",
+    "Remind me to call my mom in 10 minutes",
+    "Set a reminder to take out the trash at 8 PM",
+    "Play Bohemian Rhapsody on Spotify",
+    "Watch Stranger Things on Netflix",
+    "Who are you?",
+    "Search for the population of France",
+    "When was the Eiffel Tower built?",
+    "How far away is the moon?",
+    "echo"
+]
+
+
+def percentile(values, fraction):
+    """
+    :param values:
+    :param fraction: Between 0 and 1
+    :return the value at the fraction of the sorted values:
+    """
+    ordered = sorted(values)
+    return ordered[min(int(fraction*len(ordered)), len(ordered)-1)]
+
+
+def time_model(nlp, commands, repeat):
+    """
+    :param nlp: A loaded spaCy language
+    :param commands:
+    :param repeat: Times to parse each command
+    :return (list of the average seconds per command, list of ParseResults):
+    """
+    latencies = []
+    results = []
+    for command in commands:
+        start_time = time.time()
+        for i in range(repeat):
+            doc = nlp(command)
+        latencies.append((time.time()-start_time)/repeat)
+        results.append(parse_result.ParseResult(command, doc))
+    return latencies, results
+
+
+def routing_features(parsed):
+    """
+    :param parsed: A ParseResult
+    :return the features check functions route on:
+    """
+    return (parsed.words, parsed.lemmas, parsed.verbs, parsed.first_word)
+
+
+def route(nlp, command, parsed, subscriptions):
+    """
+    Run the check functions on a command, with the model under test standing in for both tiers
+
+    :param nlp:
+    :param command:
+    :param parsed:
+    :param subscriptions: Plugin subscriptions
+    :return frozenset of the names of matching plugins:
+    """
+    event = {
+        "command": command,
+        "parsed": parsed,
+        "verbs": parsed.verbs,
+        "ents": parsed.ents,
+        "doc": nlp(command),
+        "parse": nlp
+    }
+    matched = set()
+    for plugin in subscriptions:
+        try:
+            if plugin["check"](event):
+                matched.add(plugin["name"])
+        except Exception:
+            log.exception("Check function of plugin {0} failed on {1}".format(plugin["name"], command))
+    return frozenset(matched)
+
+
+def benchmark(model_names, commands, repeat=5, subscriptions=None):
+    """
+    Time each model on the commands and compare its routing with the last model
+
+    :param model_names: Models to compare, the last one is the reference
+    :param commands:
+    :param repeat: Times to parse each command
+    :param subscriptions: Plugin subscriptions to compare routing with. If it's None only the
+    features check functions use are compared
+    :return list of dictionaries with the results for each model:
+    """
+    models = []
+    for model_name in model_names:
+        start_time = time.time()
+        nlp = spacy.load(model_name)
+        load_time = time.time()-start_time
+        latencies, results = time_model(nlp, commands, repeat)
+        if subscriptions is not None:
+            #Plugins like easter_eggs precompute vectors, which have to come from the model being routed with
+            plugin_handler.prepare_plugins(nlp)
+        routes = [route(nlp, command, parsed, subscriptions) for command, parsed in zip(commands, results)] \
+            if subscriptions is not None else None
+        models.append((model_name, load_time, latencies, results, routes))
+    reference_name, reference_load, reference_latencies, reference_results, reference_routes = models[-1]
+    report = []
+    for model_name, load_time, latencies, results, routes in models:
+        feature_disagreements = [parsed.command for parsed, reference in zip(results, reference_results)
+                                 if routing_features(parsed) != routing_features(reference)]
+        model_report = {
+            "model": model_name,
+            "load_seconds": round(load_time, 3),
+            "mean_ms": round(sum(latencies)/len(latencies)*1000, 3),
+            "p50_ms": round(percentile(latencies, 0.5)*1000, 3),
+            "p95_ms": round(percentile(latencies, 0.95)*1000, 3),
+            "max_ms": round(max(latencies)*1000, 3),
+            "reference": reference_name,
+            "feature_agreement": 1-len(feature_disagreements)/float(len(commands)),
+            "feature_disagreements": feature_disagreements
+        }
+        if routes is not None:
+            route_disagreements = [command for command, model_route, reference_route in
+                                   zip(commands, routes, reference_routes) if model_route != reference_route]
+            model_report.update({
+                "routing_agreement": 1-len(route_disagreements)/float(len(commands)),
+                "routing_disagreements": route_disagreements
+            })
+        report.append(model_report)
+    return report
+
+
+def main(args=None):
+    """
+    Command line entry point
+
+    :param args: Argument list, defaults to sys.argv
+    """
+    arg_parser = argparse.ArgumentParser(
+        description="Compare the latency and routing of spaCy models, to pick parse_model and full_model")
+    arg_parser.add_argument("models", nargs="+", help="Models to compare, the last one is the reference")
+    arg_parser.add_argument("--commands", help="File with one command per line")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="Times to parse each command")
+    arg_parser.add_argument("--plugins", help="Plugin directory to compare routing with, like core/plugins")
+    parsed_args = arg_parser.parse_args(args)
+    commands = default_commands
+    if parsed_args.commands:
+        with open(parsed_args.commands) as commands_file:
+            commands = [line.strip() for line in commands_file if line.strip()]
+    subscriptions = None
+    if parsed_args.plugins:
+        plugin_handler.load(parsed_args.plugins, None)
+        subscriptions = plugin_handler.plugin_subscriptions
+    print(json.dumps(benchmark(parsed_args.models, commands, parsed_args.repeat, subscriptions), indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#Builtin imports
+import argparse
+import collections
+import json
+import logging
+import re
+import threading
+
+#External imports
+import numpy
+
+#Internal imports
+import core.parser as parser
+
+log = logging.getLogger()
+
+#Length of the character n-grams in the exact title index
+ngram_size = 3
+
+#Share of n-grams a query and a title need in common to count as the same title
+default_exact_threshold = 0.8
+
+_non_word = re.compile(r"[^\w ]+")
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_title(title):
+    """
+    :param title:
+    :return the title lowercased, without punctuation or extra whitespace:
+    """
+    return _whitespace.sub(" ", _non_word.sub("", title.lower())).strip()
+
+
+def ngrams(text):
+    """
+    :param text: A normalized title
+    :return set of the character n-grams of the padded text:
+    """
+    padded = " {0} ".format(text)
+    return set(padded[i:i+ngram_size] for i in range(max(len(padded)-ngram_size+1, 1)))
+
+
+def vector_path(prefix):
+    """
+    :param prefix:
+    :return path of the vector matrix:
+    """
+    return prefix+".npy"
+
+
+def table_path(prefix):
+    """
+    :param prefix:
+    :return path of the title and id table:
+    """
+    return prefix+".json"
+
+
+class ModelMismatch(Exception):
+    '''Raised when a title index was built with a different model than the one queries are embedded with'''
+    pass
+
+
+def build(titles, vector_function, prefix, model=None):
+    """
+    Write the vector matrix and id table of a title index
+
+    :param titles: title -> id
+    :param vector_function: Called with a title, returns its vector
+    :param prefix: Path without extension to write prefix.npy and prefix.json to
+    :param model: Name of the model vector_function embeds with, stored so queries can be checked against it
+    :return number of titles indexed:
+    """
+    table = sorted(titles.items())
+    vectors = numpy.array([vector_function(title) for title, title_id in table], dtype=numpy.float32)
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    numpy.save(vector_path(prefix), vectors/norms)
+    with open(table_path(prefix), "w") as table_file:
+        json.dump({"model": model, "titles": table}, table_file)
+    log.info("Indexed {0} titles to {1}".format(len(table), prefix))
+    return len(table)
+
+
+class TitleIndex:
+    '''
+    Nearest neighbour lookup of titles by vector, over a unit length float32 matrix that's memory mapped the first
+    time it's searched, plus a character n-gram index for exact title hits
+    '''
+    def __init__(self, prefix, exact_threshold=default_exact_threshold, model=None):
+        """
+        :param prefix: Path without extension of the files written by build
+        :param exact_threshold:
+        :param model: Name of the model queries are embedded with. If it's set, loading an index built with a
+        different model raises ModelMismatch
+        """
+        self.prefix = prefix
+        self.exact_threshold = exact_threshold
+        self.model = model
+        self._lock = threading.Lock()
+        self.vectors = None
+        self.table = None
+        self._ngram_index = None
+        self._ngram_counts = None
+
+    def load(self):
+        '''Map the vectors and read the id table, if that hasn't happened yet'''
+        with self._lock:
+            if self.vectors is None:
+                with open(table_path(self.prefix)) as table_file:
+                    table_data = json.load(table_file)
+                if isinstance(table_data, list):
+                    #Built before the model was recorded
+                    table_data = {"model": None, "titles": table_data}
+                if self.model is not None and table_data["model"] != self.model:
+                    raise ModelMismatch("Title index {0} was built with model {1}, but queries use model {2}".format(
+                        self.prefix, table_data["model"], self.model
+                    ))
+                self.table = [tuple(row) for row in table_data["titles"]]
+                self.vectors = numpy.load(vector_path(self.prefix), mmap_mode="r")
+                log.info("Loaded title index {0} with {1} titles".format(self.prefix, len(self.table)))
+
+    def _ngrams(self):
+        """
+        :return n-gram -> list of rows, built on first use:
+        """
+        self.load()
+        with self._lock:
+            if self._ngram_index is None:
+                ngram_index = collections.defaultdict(list)
+                ngram_counts = []
+                for row, (title, title_id) in enumerate(self.table):
+                    title_ngrams = ngrams(normalize_title(title))
+                    ngram_counts.append(len(title_ngrams))
+                    for ngram in title_ngrams:
+                        ngram_index[ngram].append(row)
+                self._ngram_counts = ngram_counts
+                self._ngram_index = dict(ngram_index)
+        return self._ngram_index
+
+    def exact(self, text):
+        """
+        Find a title that's the same as the text apart from case, punctuation, and small typos
+
+        :param text:
+        :return (title, id) or None:
+        """
+        ngram_index = self._ngrams()
+        query_ngrams = ngrams(normalize_title(text))
+        shared = collections.Counter()
+        for ngram in query_ngrams:
+            shared.update(ngram_index.get(ngram, ()))
+        best_row, best_score = None, 0.0
+        for row, shared_count in shared.items():
+            score = shared_count/float(len(query_ngrams)+self._ngram_counts[row]-shared_count)
+            if score > best_score:
+                best_row, best_score = row, score
+        if best_row is not None and best_score >= self.exact_threshold:
+            return self.table[best_row]
+        return None
+
+    def search(self, vector, k=5):
+        """
+        :param vector: The query vector
+        :param k: Number of titles to return
+        :return list of (similarity, title, id), most similar first:
+        """
+        self.load()
+        query = numpy.asarray(vector, dtype=numpy.float32)
+        query_norm = numpy.linalg.norm(query)
+        if not query_norm or not self.table:
+            return []
+        scores = self.vectors.dot(query/query_norm)
+        k = min(k, len(scores))
+        top_rows = numpy.argpartition(-scores, k-1)[:k]
+        top_rows = top_rows[numpy.argsort(-scores[top_rows])]
+        return [(float(scores[row]),)+self.table[row] for row in top_rows]
+
+    def __len__(self):
+        self.load()
+        return len(self.table)
+
+
+def main(args=None):
+    """
+    Command line entry point to build a title index
+
+    :param args: Argument list, defaults to sys.argv
+    """
+    arg_parser = argparse.ArgumentParser(description="Build a title index for nearest neighbour lookups")
+    arg_parser.add_argument("titles", help="JSON file mapping titles to ids")
+    arg_parser.add_argument("prefix", help="Output path without extension, .npy and .json files are written")
+    arg_parser.add_argument("--model", default=parser.default_model, help="The parse_model W.I.L.L is configured with")
+    arg_parser.add_argument("--full-model", help="The full_model W.I.L.L is configured with")
+    parsed_args = arg_parser.parse_args(args)
+    #Titles are embedded with the same model plugins that need vectors query with
+    parser.set_models(parsed_args.model, parsed_args.full_model)
+    with open(parsed_args.titles) as titles_file:
+        titles = json.load(titles_file)
+    title_count = build(titles, lambda title: parser.parse_full(title).vector, parsed_args.prefix,
+                        model=parser.full_model_label())
+    print("Indexed {0} titles to {1}".format(title_count, parsed_args.prefix))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#Builtin imports
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger()
+
+#Number of finished traces kept for /admin/traces
+default_buffer_size = 200
+
+
+class _Span:
+    '''Context manager that records the wall time of a stage in a trace'''
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.trace.add_span(self.name, self.start_time, time.time(), error=exc_type is not None)
+        return False
+
+
+class _NullSpan:
+    '''Span used when an event isn't being traced'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+null_span = _NullSpan()
+
+
+class Trace:
+    '''
+    The timed stages a single command went through
+    '''
+    def __init__(self, trace_id, command=None):
+        """
+        :param trace_id: Usually the command id
+        :param command: The command text
+        """
+        self.trace_id = trace_id
+        self.command = command
+        self.start_time = time.time()
+        self.end_time = None
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def span(self, name):
+        """
+        Time a stage with a with statement
+
+        :param name:
+        :return context manager:
+        """
+        return _Span(self, name)
+
+    def add_span(self, name, start_time, end_time, error=False):
+        """
+        :param name:
+        :param start_time:
+        :param end_time:
+        :param error: Whether the stage raised an exception
+        """
+        with self._lock:
+            self.spans.append((name, start_time, end_time, error))
+
+    def finish(self):
+        '''Mark the trace finished and add it to the trace buffer'''
+        self.end_time = time.time()
+        traces.add(self)
+
+    def timings(self):
+        """
+        :return list of spans with their start offset and duration in milliseconds:
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])
+        return [{
+            "name": name,
+            "start_ms": round((start_time-self.start_time)*1000, 3),
+            "duration_ms": round((end_time-start_time)*1000, 3),
+            "error": error
+        } for name, start_time, end_time, error in spans]
+
+    def to_dict(self):
+        """
+        :return json serializable dictionary of the trace:
+        """
+        end_time = self.end_time or time.time()
+        return {
+            "id": self.trace_id,
+            "command": self.command,
+            "started": self.start_time,
+            "duration_ms": round((end_time-self.start_time)*1000, 3),
+            "spans": self.timings()
+        }
+
+
+class TraceBuffer:
+    '''
+    Ring buffer of the most recently finished traces
+    '''
+    def __init__(self, size=default_buffer_size):
+        self._traces = collections.deque(maxlen=size)
+
+    def add(self, trace):
+        """
+        :param trace:
+        """
+        self._traces.append(trace)
+
+    def recent(self, limit=None):
+        """
+        :param limit: Most traces to return
+        :return list of trace dictionaries, newest first:
+        """
+        recent_traces = list(self._traces)[::-1]
+        if limit:
+            recent_traces = recent_traces[:limit]
+        return [trace.to_dict() for trace in recent_traces]
+
+traces = TraceBuffer()
+
+
+def span(event, name):
+    """
+    Time a stage of the command an event belongs to, if it's being traced
+
+    :param event:
+    :param name:
+    :return context manager:
+    """
+    trace = event.get("trace")
+    if trace:
+        return trace.span(name)
+    return null_span
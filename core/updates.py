@@ -0,0 +1,230 @@
+#Builtin imports
+import collections
+import logging
+import threading
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+log = logging.getLogger()
+
+default_buffer_size = 100
+
+#drop_oldest keeps every update until the buffer is full.
+#coalesce also replaces an unacknowledged update for the same command or event with the newer one
+default_policy = "drop_oldest"
+
+policies = ["drop_oldest", "coalesce"]
+
+
+def coalesce_key(update_data):
+    """
+    :param update_data:
+    :return a key identifying the command or event an update is about, or None:
+    """
+    if "command_id" in update_data:
+        return ("command", update_data["command_id"])
+    event_data = update_data.get("data")
+    if isinstance(event_data, dict) and "uid" in event_data:
+        return (update_data.get("type"), event_data["uid"])
+    return None
+
+
+class UpdateBuffer:
+    '''
+    A sessions pending updates, numbered with increasing sequence numbers.
+    Updates are kept until the client acknowledges them or the buffer is full, so a reconnecting
+    client can resume from the last sequence number it saw
+    '''
+    def __init__(self, size=default_buffer_size, policy=default_policy):
+        """
+        :param size: The most updates kept at once
+        :param policy: One of policies
+        """
+        assert policy in policies
+        self.size = size
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._updates = collections.deque()
+        self._sequence = 0
+        self.acked = 0
+        self.dropped = 0
+
+    def put(self, update_data):
+        """
+        Add an update. The buffered copy gets a seq key with its sequence number
+
+        :param update_data:
+        :return the sequence number:
+        """
+        key = coalesce_key(update_data) if self.policy == "coalesce" else None
+        with self._lock:
+            self._sequence += 1
+            if key is not None:
+                for buffered in list(self._updates):
+                    if coalesce_key(buffered) == key:
+                        self._updates.remove(buffered)
+                        self.dropped += 1
+            buffered_update = dict(update_data)
+            buffered_update.update({"seq": self._sequence})
+            self._updates.append(buffered_update)
+            while len(self._updates) > self.size:
+                self._updates.popleft()
+                self.dropped += 1
+            return self._sequence
+
+    def since(self, seq):
+        """
+        :param seq:
+        :return list of buffered updates with a sequence number after seq:
+        """
+        with self._lock:
+            return [update_data for update_data in self._updates if update_data["seq"] > seq]
+
+    def ack(self, seq):
+        """
+        Drop updates the client has received
+
+        :param seq: The last sequence number the client received
+        """
+        with self._lock:
+            self.acked = max(self.acked, min(seq, self._sequence))
+            while self._updates and self._updates[0]["seq"] <= self.acked:
+                self._updates.popleft()
+
+    def last_seq(self):
+        """
+        :return the sequence number of the newest update:
+        """
+        return self._sequence
+
+    def qsize(self):
+        """
+        :return number of buffered updates:
+        """
+        return len(self._updates)
+
+
+class UpdatePusher:
+    '''
+    A single thread that pushes session updates to subscribed socket.io clients as soon as they're buffered
+    '''
+    def __init__(self, sessions):
+        """
+        :param sessions: The session_id -> session dictionary
+        """
+        self.sessions = sessions
+        self.emit_function = None
+        #Session ids that have new updates
+        self._ready = Queue.Queue()
+        self._lock = threading.Lock()
+        #session_id -> set of socket.io sids
+        self._subscribers = {}
+        #sid -> session_id
+        self._subscriptions = {}
+        #sid -> sequence number of the last update pushed to it
+        self._cursors = {}
+
+    def subscribe(self, session_id, sid, last_seq=None):
+        """
+        Push a sessions updates to a socket.io client, starting with anything it hasn't seen
+
+        :param session_id:
+        :param sid: The socket.io session id
+        :param last_seq: The last sequence number the client received. If it's None, every
+        update that hasn't been acknowledged is replayed
+        """
+        session_data = self.sessions.get(session_id)
+        if not session_data:
+            return
+        session_updates = session_data["updates"]
+        if last_seq is None:
+            last_seq = session_updates.acked
+        else:
+            session_updates.ack(last_seq)
+        with self._lock:
+            self._subscribers.setdefault(session_id, set()).add(sid)
+            self._subscriptions.update({sid: session_id})
+            self._cursors.update({sid: last_seq})
+        self.notify(session_id)
+
+    def ack(self, session_id, seq):
+        """
+        :param session_id:
+        :param seq: The last sequence number the client received
+        """
+        session_data = self.sessions.get(session_id)
+        if session_data:
+            session_data["updates"].ack(seq)
+
+    def unsubscribe(self, sid):
+        """
+        :param sid: The socket.io session id of a disconnected client
+        """
+        with self._lock:
+            session_id = self._subscriptions.pop(sid, None)
+            self._cursors.pop(sid, None)
+            session_subscribers = self._subscribers.get(session_id)
+            if session_subscribers is not None:
+                session_subscribers.discard(sid)
+                if not session_subscribers:
+                    del self._subscribers[session_id]
+
+    def notify(self, session_id):
+        """
+        Wake the push thread for a session with new updates
+
+        :param session_id:
+        """
+        self._ready.put(session_id)
+
+    def push(self, session_id, update_data):
+        """
+        Buffer an update for a session and wake the push thread
+
+        :param session_id:
+        :param update_data:
+        """
+        session_data = self.sessions.get(session_id)
+        if session_data:
+            session_data["updates"].put(update_data)
+            self.notify(session_id)
+
+    def _push_session(self, session_id):
+        """
+        Emit the updates each subscriber of a session hasn't been sent yet
+
+        :param session_id:
+        """
+        with self._lock:
+            cursors = [(sid, self._cursors[sid]) for sid in self._subscribers.get(session_id, ())]
+        session_data = self.sessions.get(session_id)
+        #Leave the updates buffered until a client subscribes
+        if not (cursors and session_data and self.emit_function):
+            return
+        session_updates = session_data["updates"]
+        for sid, cursor in cursors:
+            pending = session_updates.since(cursor)
+            for update in pending:
+                log.debug("Pushing update {0}".format(update))
+                self.emit_function('update', update, room=sid)
+            if pending:
+                with self._lock:
+                    if sid in self._cursors:
+                        self._cursors[sid] = max(self._cursors[sid], pending[-1]["seq"])
+
+    def _push_loop(self):
+        '''Push thread'''
+        while True:
+            session_id = self._ready.get()
+            try:
+                self._push_session(session_id)
+            except Exception:
+                log.exception(":{0}:Error pushing updates".format(session_id))
+
+    def start(self):
+        '''Start the push thread'''
+        push_thread = threading.Thread(target=self._push_loop, name="update-pusher")
+        push_thread.daemon = True
+        push_thread.start()
@@ -0,0 +1,255 @@
+#Builtin imports
+import heapq
+import logging
+import threading
+import time
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+log = logging.getLogger()
+
+
+class PoolFull(Exception):
+    '''Raised when a worker pool's queue is saturated'''
+    pass
+
+
+class TaskTimeout(Exception):
+    '''Raised when waiting on a task runs past its timeout'''
+    pass
+
+
+class Task:
+    '''
+    A result that will be filled in later by a worker.
+    The first result or exception set wins, any later ones are ignored
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done_event = threading.Event()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def _finish(self, result, exception):
+        """
+        Store the outcome of the task and run the done callbacks
+
+        :param result:
+        :param exception:
+        :return boolean, whether this call finished the task:
+        """
+        with self._lock:
+            if self._done_event.is_set():
+                return False
+            self._result = result
+            self._exception = exception
+            self._done_event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            self._run_callback(callback)
+        return True
+
+    def _run_callback(self, callback):
+        """
+        Run a done callback, logging instead of raising if it fails
+
+        :param callback:
+        """
+        try:
+            callback(self)
+        except Exception:
+            log.exception("Error in done callback {0} for task {1}".format(callback, self))
+
+    def set_result(self, result):
+        """
+        :param result:
+        :return boolean:
+        """
+        return self._finish(result, None)
+
+    def set_exception(self, exception):
+        """
+        :param exception:
+        :return boolean:
+        """
+        return self._finish(None, exception)
+
+    def done(self):
+        """
+        :return boolean:
+        """
+        return self._done_event.is_set()
+
+    def add_done_callback(self, callback):
+        """
+        Run callback(task) once the task is finished. If it's already finished, run it now
+
+        :param callback:
+        """
+        with self._lock:
+            if not self._done_event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def result(self, timeout=None):
+        """
+        Wait for the task to finish and return its result
+
+        :param timeout: Seconds to wait, or None to wait forever
+        :return the result of the task:
+        """
+        if not self._done_event.wait(timeout):
+            raise TaskTimeout("Task didn't finish within {0} seconds".format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def finished(result):
+    """
+    :param result:
+    :return a Task that's already finished with the result:
+    """
+    task = Task()
+    task.set_result(result)
+    return task
+
+
+def chain(source, target):
+    """
+    Finish target with the outcome of source once source is finished
+
+    :param source: Task
+    :param target: Task
+    """
+    def copy_outcome(finished_task):
+        try:
+            target.set_result(finished_task.result(0))
+        except Exception as task_exception:
+            target.set_exception(task_exception)
+    source.add_done_callback(copy_outcome)
+
+
+class WorkerPool:
+    '''
+    A fixed number of worker threads pulling from a bounded queue
+    '''
+    def __init__(self, name, workers, queue_depth, work_queue=None):
+        """
+        Start the worker threads
+
+        :param name: Name used for the threads and in logging
+        :param workers: Number of worker threads
+        :param queue_depth: Number of tasks that can wait for a worker before submit raises PoolFull
+        :param work_queue: Queue the workers get (task, function, args, kwargs) from, a bounded Queue by default
+        """
+        self.name = name
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._queue = work_queue if work_queue is not None else Queue.Queue(maxsize=queue_depth)
+        self._active = 0
+        self._active_lock = threading.Lock()
+        for worker_num in range(workers):
+            worker_thread = threading.Thread(
+                target=self._work, name="{0}-{1}".format(name, worker_num))
+            worker_thread.daemon = True
+            worker_thread.start()
+        log.info("Started worker pool {0} with {1} workers and a queue depth of {2}".format(
+            name, workers, queue_depth
+        ))
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue a function to be run by a worker
+
+        :param function:
+        :return Task:
+        """
+        task = Task()
+        try:
+            self._queue.put_nowait((task, function, args, kwargs))
+        except Queue.Full:
+            raise PoolFull("Worker pool {0} is saturated".format(self.name))
+        return task
+
+    def queued(self):
+        """
+        :return number of tasks waiting for a worker:
+        """
+        return self._queue.qsize()
+
+    def active(self):
+        """
+        :return number of tasks currently being run:
+        """
+        return self._active
+
+    def _work(self):
+        '''Worker loop'''
+        while True:
+            task, function, args, kwargs = self._queue.get()
+            with self._active_lock:
+                self._active += 1
+            try:
+                task.set_result(function(*args, **kwargs))
+            except Exception as task_exception:
+                log.exception("Worker pool {0} task {1} raised an exception".format(self.name, function))
+                task.set_exception(task_exception)
+            finally:
+                with self._active_lock:
+                    self._active -= 1
+
+
+class Deadlines:
+    '''
+    One thread that runs callbacks when their deadlines pass, so callers can give up on a task without
+    blocking a thread to wait on it
+    '''
+    def __init__(self, name="deadlines"):
+        """
+        :param name: Name of the thread
+        """
+        self._condition = threading.Condition()
+        #Heap of (deadline, sequence number, callback)
+        self._heap = []
+        self._sequence = 0
+        deadline_thread = threading.Thread(target=self._watch, name=name)
+        deadline_thread.daemon = True
+        deadline_thread.start()
+
+    def add(self, timeout, callback):
+        """
+        Run callback() after a timeout. It's run even if the task it's watching has finished,
+        so it should check that itself
+
+        :param timeout: Seconds from now
+        :param callback:
+        """
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._heap, (time.time()+timeout, self._sequence, callback))
+            self._condition.notify()
+
+    def pending(self):
+        """
+        :return number of deadlines that haven't passed:
+        """
+        with self._condition:
+            return len(self._heap)
+
+    def _watch(self):
+        '''Deadline loop'''
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._condition.wait(self._heap[0][0]-time.time() if self._heap else None)
+                deadline, sequence, callback = heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception:
+                log.exception("Error in deadline callback {0}".format(callback))
@@ -2,10 +2,36 @@ import unittest
 import tools
 import json
 import os
+import sys
 import dataset
+import numpy
 import core.plugin_handler as plugin_handler
 import core.notification as notification
+import core.scheduler as scheduler
+import core.workers as workers
+import core.dispatcher as dispatcher
+import core.event_journal as event_journal
+import core.event_actions as event_actions
+import core.session_registry as session_registry
+import core.updates as updates
+import core.metrics as metrics
+import core.tracing as tracing
+import core.batcher as batcher
+import core.parser as parser
+import core.parse_result as parse_result
+import core.parse_cache as parse_cache
+import core.lazy_parse as lazy_parse
+import core.title_index as title_index
+import core.check_runner as check_runner
+import core.breaker as breaker
+import core.lanes as lanes
+import core.response_cache as response_cache
 import logging
+import multiprocessing
+import tempfile
+import datetime
+import threading
+import time
 
 logging.basicConfig(filename="unittests.log", level=logging.DEBUG)
 
@@ -86,5 +112,526 @@ class notification_send(unittest.TestCase):
              "value": "This is a sample reminder that also tests the 5 word summary"},
             db)
 
+class workers_tests(unittest.TestCase):
+    def test_saturation(self):
+        started, release = threading.Event(), threading.Event()
+        def block():
+            started.set()
+            return release.wait(1)
+        pool = workers.WorkerPool("test", 1, 1)
+        running = pool.submit(block)
+        started.wait(1)
+        queued = pool.submit(lambda: "queued")
+        self.assertRaises(workers.PoolFull, pool.submit, lambda: None)
+        release.set()
+        self.assertTrue(running.result(1))
+        self.assertEqual(queued.result(1), "queued")
+    def test_task(self):
+        failing = workers.WorkerPool("test", 1, 1).submit(lambda: 1/0)
+        self.assertRaises(ZeroDivisionError, failing.result, 1)
+        source, target = workers.Task(), workers.Task()
+        workers.chain(source, target)
+        self.assertRaises(workers.TaskTimeout, target.result, 0)
+        self.assertTrue(source.set_result("first"))
+        self.assertFalse(source.set_result("second"))
+        self.assertEqual(target.result(0), "first")
+        self.assertEqual(workers.finished("done").result(0), "done")
+
+class dispatcher_tests(unittest.TestCase):
+    def test_detach(self):
+        release = threading.Event()
+        delivered = []
+        def command_function(command_data, session, db, add_to_updates_queue=True):
+            release.wait(1)
+            return workers.finished({"type": "success", "text": command_data["command"], "data": {}})
+        command_dispatcher = dispatcher.CommandDispatcher(
+            command_function, lambda session_id, update_data: delivered.append((session_id, update_data)), worker_num=1)
+        pending = command_dispatcher.dispatch({"id": "1", "command": "slow"}, {"id": "session"}, None)
+        self.assertIsNone(pending.wait(0.01))
+        release.set()
+        pending.task.result(1)
+        self.assertEqual(delivered, [("session", {"command_id": "1", "response": {
+            "type": "success", "text": "slow", "data": {}}})])
+    def test_error_response(self):
+        def command_function(command_data, session, db, add_to_updates_queue=True):
+            raise ValueError("broken plugin")
+        command_dispatcher = dispatcher.CommandDispatcher(command_function, None, worker_num=1)
+        response = command_dispatcher.dispatch({"id": "1", "command": "error"}, {"id": "session"}, None).wait(1)
+        self.assertEqual(response["type"], "error")
+    def test_saturation(self):
+        started, release = threading.Event(), threading.Event()
+        def command_function(command_data, session, db, add_to_updates_queue=True):
+            started.set()
+            release.wait(1)
+            return {"type": "success", "text": command_data["command"], "data": {}}
+        command_dispatcher = dispatcher.CommandDispatcher(command_function, None, worker_num=1, queue_depth=1)
+        command_dispatcher.dispatch({"id": "1", "command": "running"}, {"id": "session"}, None)
+        started.wait(1)
+        queued = command_dispatcher.dispatch({"id": "2", "command": "queued"}, {"id": "session"}, None)
+        self.assertRaises(workers.PoolFull, command_dispatcher.dispatch, {"id": "3", "command": "full"},
+                          {"id": "session"}, None)
+        release.set()
+        self.assertEqual(queued.wait(1)["text"], "queued")
+
+class scheduler_tests(unittest.TestCase):
+    def test_order(self):
+        events = scheduler.EventScheduler()
+        now = time.time()
+        events.insert({"uid": "b", "time": now-1})
+        events.insert({"uid": "a", "time": now-2})
+        events.insert({"uid": "c", "time": now+60})
+        self.assertEqual(events.wait_next(0)["uid"], "a")
+        self.assertEqual(events.wait_next(0)["uid"], "b")
+        self.assertEqual(events.wait_next(0), None)
+        self.assertEqual(len(events), 1)
+    def test_cancel(self):
+        events = scheduler.EventScheduler()
+        events.insert({"uid": "a", "time": time.time()-1})
+        self.assertEqual(events.cancel("a")["uid"], "a")
+        self.assertEqual(events.cancel("a"), None)
+        self.assertEqual(events.wait_next(0), None)
+
+class event_journal_tests(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "events.journal")
+        self.journal = event_journal.EventJournal(self.path, compact_interval=3600)
+    def tearDown(self):
+        self.journal.close()
+    def test_replay(self):
+        events = scheduler.EventScheduler(self.journal)
+        now = time.time()
+        events.insert({"uid": "a", "type": "notification", "time": now-1})
+        events.insert({"uid": "b", "type": "notification", "time": now+60})
+        events.insert({"uid": "c", "type": "url", "time": now+60})
+        events.insert({"uid": "f", "type": "function", "time": now+60})
+        self.assertEqual(events.wait_next(0)["uid"], "a")
+        events.cancel("c")
+        self.journal.commit()
+        pending = event_journal.EventJournal(self.path).replay({})
+        self.assertEqual(sorted(pending), ["b"])
+    def test_crash_recovery(self):
+        self.journal.record_insert({"uid": "a", "type": "notification", "time": 1})
+        self.journal.commit()
+        #A compaction that rotated the journal but never reached the db, then a torn write
+        os.rename(self.path, self.path+".old")
+        with open(self.path, "w") as journal_file:
+            journal_file.write(json.dumps({"op": "insert", "event": {"uid": "b", "type": "url", "time": 2}})+"\n")
+            journal_file.write('{"op": "done", "ui')
+        pending = event_journal.EventJournal(self.path).replay({"c": {"uid": "c"}})
+        self.assertEqual(sorted(pending), ["a", "b", "c"])
+    def test_compact(self):
+        db = dataset.connect("sqlite:///:memory:")
+        events = scheduler.EventScheduler(self.journal)
+        events.insert({"uid": "a", "type": "notification", "time": time.time()+60, "username": "willbeddow"})
+        self.journal.start(lambda: list(events), db)
+        self.journal.compact()
+        self.assertFalse(os.path.isfile(self.path+".old"))
+        self.assertEqual([row["uid"] for row in db["events"].all()], ["a"])
+        self.assertEqual(event_journal.EventJournal(self.path).replay({}), {})
+
+class event_actions_tests(unittest.TestCase):
+    def setUp(self):
+        self.updates = []
+        self.retried = []
+        self.executor = event_actions.EventExecutor(
+            None, lambda username, update_data: self.updates.append(update_data), self.retried.append,
+            limits={"url": 1, "function": 1}, queue_depth=1, timeouts={"function": 0.05})
+    def test_retry_and_isolation(self):
+        started, release = threading.Event(), threading.Event()
+        def blocking_url(event):
+            started.set()
+            release.wait(1)
+        self.executor.actions["url"] = blocking_url
+        now = time.time()
+        self.executor.fire({"uid": "running", "type": "url", "time": now, "username": "willbeddow"})
+        started.wait(1)
+        self.executor.fire({"uid": "queued", "type": "url", "time": now, "username": "willbeddow"})
+        self.executor.fire({"uid": "full", "type": "url", "time": now, "username": "willbeddow"})
+        self.assertEqual([event["uid"] for event in self.retried], ["full"])
+        self.assertGreater(self.retried[0]["time"], now)
+        self.assertEqual(self.retried[0]["due"], now)
+        #Lag counts from the original due time, even though the retry moved the event forward
+        self.assertGreaterEqual(self.executor.record_lag(dict(self.retried[0], due=now-5)), 5)
+        #A saturated url pool doesn't hold up function events
+        self.executor.fire({"uid": "function", "type": "function", "time": now, "username": "willbeddow",
+                            "value": lambda: "ran"})
+        time.sleep(0.1)
+        release.set()
+        self.assertEqual([update_data["text"] for update_data in self.updates], ["ran"])
+    def test_function_timeout(self):
+        self.executor.fire({"uid": "slow", "type": "function", "time": time.time(), "username": "willbeddow",
+                            "value": lambda: time.sleep(0.2) or "late"})
+        time.sleep(0.3)
+        self.assertEqual([update_data["text"] for update_data in self.updates],
+                         ["Event slow didn't finish within 0.05 seconds"])
+    def test_conditional_get(self):
+        class FakeResponse:
+            def __init__(self, status_code, text, headers):
+                self.status_code = status_code
+                self.text = text
+                self.headers = headers
+        requests_made = []
+        def fake_get(url, headers=None, timeout=None):
+            requests_made.append(headers)
+            if headers.get("If-None-Match") == "v1":
+                return FakeResponse(304, "", {})
+            return FakeResponse(200, "page", {"ETag": "v1"})
+        real_get = event_actions.requests.get
+        event_actions.requests.get = fake_get
+        try:
+            self.assertEqual(self.executor.fetch_url("http://example.com"), "page")
+            self.assertEqual(self.executor.fetch_url("http://example.com"), "page")
+        finally:
+            event_actions.requests.get = real_get
+        self.assertEqual(requests_made, [{}, {"If-None-Match": "v1"}])
+
+class session_registry_tests(unittest.TestCase):
+    def test_index(self):
+        sessions = session_registry.SessionRegistry()
+        sessions.add({"id": "1", "username": "willbeddow"})
+        sessions.add({"id": "2", "username": "willbeddow"})
+        sessions.update({"3": {"id": "3", "username": "other"}})
+        self.assertEqual(sessions.session_ids("willbeddow"), {"1", "2"})
+        self.assertEqual(sessions.user_count(), 2)
+        del sessions["1"]
+        sessions.remove("3")
+        self.assertEqual(sessions.session_ids("willbeddow"), {"2"})
+        self.assertEqual(sessions.users(), ["willbeddow"])
+        self.assertEqual(sessions.session_count(), 1)
+
+class session_reaper_tests(unittest.TestCase):
+    def test_reap(self):
+        sessions = session_registry.SessionRegistry()
+        now = datetime.datetime.now()
+        stale_listener = {"id": "1", "function": len, "event": {}, "response_expires": time.time()-1}
+        live_listener = {"id": "2", "function": len, "event": {}, "response_expires": time.time()+60}
+        sessions.add({"id": "active", "username": "willbeddow", "created": now, "last_active": time.time(),
+                      "commands": [stale_listener, live_listener]})
+        sessions.add({"id": "idle", "username": "willbeddow", "created": now, "last_active": time.time()-120,
+                      "commands": []})
+        sessions.add({"id": "old", "username": "other", "created": now-datetime.timedelta(seconds=7200),
+                      "last_active": time.time(), "commands": []})
+        reaper = session_registry.SessionReaper(sessions, sessions.remove, idle_ttl=60, max_age=3600)
+        self.assertEqual(reaper.reap(), 2)
+        self.assertEqual(list(sessions.keys()), ["active"])
+        self.assertEqual(stale_listener, {"id": "1"})
+        self.assertIn("function", live_listener)
+
+class update_buffer_tests(unittest.TestCase):
+    def test_resume(self):
+        buffer = updates.UpdateBuffer(size=3)
+        for i in range(5):
+            buffer.put({"text": i})
+        self.assertEqual([update["seq"] for update in buffer.since(0)], [3, 4, 5])
+        buffer.ack(4)
+        self.assertEqual([update["text"] for update in buffer.since(0)], [4])
+        self.assertEqual(buffer.dropped, 2)
+    def test_coalesce(self):
+        buffer = updates.UpdateBuffer(policy="coalesce")
+        buffer.put({"command_id": "a", "response": 1})
+        buffer.put({"command_id": "a", "response": 2})
+        self.assertEqual([update["response"] for update in buffer.since(0)], [2])
+
+class update_pusher_tests(unittest.TestCase):
+    def test_resume_and_unsubscribe(self):
+        pushed = []
+        pusher = updates.UpdatePusher({"session": {"updates": updates.UpdateBuffer()}})
+        pusher.emit_function = lambda event, update_data, room: pushed.append((room, update_data["seq"]))
+        for i in range(3):
+            pusher.push("session", {"type": "event", "text": str(i), "data": {}})
+        pusher.subscribe("session", "client", last_seq=1)
+        pusher._push_session("session")
+        self.assertEqual(pushed, [("client", 2), ("client", 3)])
+        self.assertEqual(pusher.sessions["session"]["updates"].qsize(), 2)
+        pusher.push("session", {"type": "event", "text": "3", "data": {}})
+        pusher._push_session("session")
+        self.assertEqual(pushed[2:], [("client", 4)])
+        pusher.unsubscribe("client")
+        pusher.push("session", {"type": "event", "text": "4", "data": {}})
+        pusher._push_session("session")
+        self.assertEqual(len(pushed), 3)
+        #Updates stay buffered for the next client until they're acknowledged
+        self.assertEqual(pusher.sessions["session"]["updates"].qsize(), 4)
+
+class metrics_tests(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter("test_total", "Test counter", ["result"]))
+        histogram = registry.register(metrics.Histogram("test_seconds", "Test histogram", buckets=(0.1, 1)))
+        counter.inc(result="success")
+        histogram.observe(0.5)
+        rendered = registry.render()
+        self.assertIn('test_total{result="success"} 1.0', rendered)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0.0', rendered)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 1.0', rendered)
+        self.assertIn('test_seconds_count 1.0', rendered)
+
+class tracing_tests(unittest.TestCase):
+    def test_spans(self):
+        trace = tracing.Trace("test-command", "test")
+        with trace.span("parse"):
+            pass
+        with tracing.span({"trace": trace}, "routing"):
+            pass
+        with tracing.span({}, "untraced"):
+            pass
+        self.assertEqual([span["name"] for span in trace.timings()], ["parse", "routing"])
+
+class batcher_tests(unittest.TestCase):
+    def test_batch(self):
+        batches = []
+        def pipe(texts, batch_size):
+            batches.append(list(texts))
+            return [text.upper() for text in texts]
+        parse_batcher = batcher.ParseBatcher(pipe, window=0.05, batch_size=2)
+        tasks = [parse_batcher.submit(text) for text in ["a", "b", "c"]]
+        parse_batcher.start()
+        self.assertEqual([task.result(1) for task in tasks], ["A", "B", "C"])
+        self.assertEqual(batches, [["a", "b"], ["c"]])
+
+class parse_result_tests(unittest.TestCase):
+    def test_features(self):
+        doc = parse_result.CompactDoc(
+            "Play Hello on Spotify",
+            [("Play", " ", "play", "VERB", "VB", "ROOT", 0), ("Hello", " ", "hello", "PROPN", "NNP", "dobj", 0),
+             ("on", " ", "on", "ADP", "IN", "prep", 0), ("Spotify", "", "spotify", "PROPN", "NNP", "pobj", 2)],
+            [(1, 2), (3, 4)], [(3, 4, "ORG")])
+        parsed = parse_result.ParseResult(doc.text, doc)
+        self.assertIn("spotify", parsed.words)
+        self.assertEqual(parsed.verbs, frozenset(["play"]))
+        self.assertEqual(parsed.ents, {"ORG": "Spotify"})
+        self.assertEqual(parsed.chunks_with_dep("dobj"), ["Hello"])
+        self.assertEqual(parsed.first_word, "play")
+
+class parse_process_tests(unittest.TestCase):
+    def setUp(self):
+        parser.set_models(parser.model_name)
+    def test_worker_parse(self):
+        command = "Remind me to call my mom in Paris in 10 minutes"
+        parse_pool = multiprocessing.Pool(1, initializer=parser._init_worker, initargs=(parser.model_name,))
+        try:
+            worker_doc = parse_pool.apply_async(parser._parse_in_worker, (command,)).get(60)
+        finally:
+            parse_pool.terminate()
+        local_doc = parse_result.CompactDoc.from_doc(parser.nlp(command))
+        self.assertEqual(worker_doc.tokens, local_doc.tokens)
+        self.assertEqual(worker_doc.noun_chunk_offsets, local_doc.noun_chunk_offsets)
+        self.assertEqual(worker_doc.ent_offsets, local_doc.ent_offsets)
+        self.assertEqual(parse_result.ParseResult(command, worker_doc).to_dict(),
+                         parse_result.ParseResult(command, local_doc).to_dict())
+
+class parse_cache_tests(unittest.TestCase):
+    def test_lru(self):
+        cache = parse_cache.ParseCache(max_entries=2)
+        cache.put("what's the weather", ["what", "'s", "the", "weather"])
+        cache.put("read me the news", ["read", "me", "the", "news"])
+        self.assertIsNotNone(cache.get("what's  the weather "))
+        cache.put("echo", ["echo"])
+        self.assertIsNone(cache.get("read me the news"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_memory_cap(self):
+        cache = parse_cache.ParseCache(max_bytes=parse_cache.token_bytes*3)
+        cache.put("a b", ["a", "b"])
+        cache.put("c d", ["c", "d"])
+        self.assertEqual(len(cache), 1)
+
+class lazy_parse_tests(unittest.TestCase):
+    def test_stages(self):
+        ran = []
+        doc = parse_result.CompactDoc("echo", [("echo", "", "echo", "VERB", "VB", "ROOT", 0)], [], [])
+        pipes = [(stage, lambda doc, stage=stage: ran.append(stage)) for stage in lazy_parse.stages]
+        lazy_doc = lazy_parse.LazyDoc("echo", type("language", (), {"tokenizer": lambda text: doc}), pipes)
+        event = lazy_parse.LazyEvent(lazy_doc, {"parsed": parse_result.LazyParseResult("echo", lazy_doc)})
+        self.assertIn("echo", event["parsed"].words)
+        self.assertEqual(ran, [])
+        self.assertEqual(event["verbs"], frozenset(["echo"]))
+        self.assertEqual(ran, ["tagger"])
+        event["doc"]
+        self.assertEqual(ran, ["tagger", "parser", "ner"])
+    def test_full_parse(self):
+        ran = []
+        doc = parse_result.CompactDoc("echo", [("echo", "", "echo", "VERB", "VB", "ROOT", 0)], [], [])
+        pipes = [(stage, lambda doc, stage=stage: ran.append(stage)) for stage in lazy_parse.stages]
+        lazy_doc = lazy_parse.LazyDoc("echo", type("language", (), {"tokenizer": lambda text: doc}), pipes,
+                                      full_parse=lambda text: ran.append("batch") or doc)
+        lazy_doc.require("tagger")
+        self.assertIs(lazy_doc.full(), doc)
+        self.assertEqual(ran, ["tagger", "batch"])
+        lazy_doc.full()
+        self.assertEqual(ran, ["tagger", "batch"])
+
+class phrase_tests(unittest.TestCase):
+    def test_match(self):
+        subscription_data = {"name": "test_phrases", "check": lambda event: False}
+        plugin_handler.add_phrases(subscription_data, ["Who are you?"])
+        phrase, matched = plugin_handler.match_phrase("  who ARE you ")
+        self.assertEqual(phrase, "who are you")
+        self.assertIs(matched, subscription_data)
+        self.assertEqual(plugin_handler.match_phrase("who are you really"), (None, None))
+        plugin_handler.phrase_table.pop(phrase)
+
+class title_index_tests(unittest.TestCase):
+    def test_lookup(self):
+        vectors = {"The Office": [1, 0, 0], "Breaking Bad": [0, 1, 0], "House of Cards": [0, 1, 1]}
+        prefix = os.path.join(tempfile.mkdtemp(), "shows")
+        title_index.build({"The Office": 1, "Breaking Bad": 2, "House of Cards": 3}, vectors.get, prefix, model="test")
+        shows_index = title_index.TitleIndex(prefix, model="test")
+        self.assertEqual(shows_index.exact("the office!"), ("The Office", 1))
+        self.assertIsNone(shows_index.exact("office space"))
+        self.assertEqual([result[1] for result in shows_index.search([0, 1, 0.9], k=2)],
+                         ["House of Cards", "Breaking Bad"])
+        self.assertRaises(title_index.ModelMismatch, title_index.TitleIndex(prefix, model="other").load)
+
+class easter_egg_tests(unittest.TestCase):
+    def setUp(self):
+        plugin_handler.PythonLoader("core/plugins/easter_eggs.py").load()
+        self.easter_eggs = sys.modules["easter_eggs"]
+        self.egg_matrix = self.easter_eggs.egg_matrix
+        #One unit axis per phrase, so a commands similarity with a phrase is easy to work out
+        self.easter_eggs.egg_matrix = numpy.eye(len(self.easter_eggs.egg_phrases), dtype=numpy.float32)
+    def tearDown(self):
+        self.easter_eggs.egg_matrix = self.egg_matrix
+    def event(self, vector):
+        doc = parse_result.CompactDoc("who", [("who", "", "who", "PRON", "WP", "ROOT", 0)], [], [], vector)
+        return {"parsed": parse_result.ParseResult("who", doc)}
+    def test_threshold(self):
+        vector = numpy.zeros(len(self.easter_eggs.egg_phrases))
+        vector[2], vector[5] = 1, 0.2
+        event = self.event(vector)
+        similarity, phrase = self.easter_eggs.best_egg(event)
+        self.assertAlmostEqual(similarity, 1/1.04**0.5, places=5)
+        self.assertEqual(phrase, self.easter_eggs.egg_phrases[2])
+        self.assertTrue(self.easter_eggs.egg_hunt(event))
+        self.assertEqual(event["easter_egg"], phrase)
+        #About 0.958, just under the threshold
+        vector[5] = 0.3
+        self.assertFalse(self.easter_eggs.egg_hunt(self.event(vector)))
+        self.assertEqual(self.easter_eggs.best_egg(self.event(numpy.zeros(3))), (0.0, None))
+    def test_prepare(self):
+        phrase_count = len(self.easter_eggs.egg_phrases)
+        vectors = dict((phrase, numpy.eye(phrase_count)[index]*3)
+                       for index, phrase in enumerate(self.easter_eggs.egg_phrases))
+        self.easter_eggs.prepare(lambda text: type("doc", (), {"vector": vectors[text]}))
+        self.assertTrue(numpy.allclose(self.easter_eggs.egg_matrix, numpy.eye(phrase_count)))
+
+class trigger_tests(unittest.TestCase):
+    def test_candidates(self):
+        plugin_handler.subscribe({"name": "test_triggers", "check": lambda event: True,
+                                  "triggers": {"words": ["trigger"], "first_words": ["please"]}})(lambda event: None)
+        subscription_data = plugin_handler.plugins_by_name["test_triggers"]
+        doc = parse_result.CompactDoc("please trigger it", [
+            ("please", " ", "please", "INTJ", "UH", "intj", 1), ("trigger", " ", "trigger", "VERB", "VB", "ROOT", 1),
+            ("it", "", "it", "PRON", "PRP", "dobj", 1)], [], [])
+        candidates = plugin_handler.candidates({"parsed": parse_result.ParseResult(doc.text, doc)})
+        self.assertEqual(candidates.count(subscription_data), 1)
+        doc = parse_result.CompactDoc("hello", [("hello", "", "hello", "INTJ", "UH", "ROOT", 0)], [], [])
+        self.assertNotIn(subscription_data, plugin_handler.candidates({"parsed": parse_result.ParseResult("hello", doc)}))
+        plugin_handler.plugin_subscriptions.remove(subscription_data)
+        plugin_handler.plugins_by_name.pop("test_triggers")
+        plugin_handler.trigger_index["words"]["trigger"].remove(subscription_data)
+        plugin_handler.trigger_index["first_words"]["please"].remove(subscription_data)
+    def test_unmatched(self):
+        plugin_handler.subscribe({"name": "test_unmatched", "check": lambda event: True, "check_unmatched": True,
+                                  "triggers": {"first_words": ["please"]}})(lambda event: None)
+        subscription_data = plugin_handler.plugins_by_name["test_unmatched"]
+        #A command the triggers didn't pick out is still checked once nothing else matched it
+        self.assertIn(subscription_data, plugin_handler.unmatched_candidates([]))
+        self.assertNotIn(subscription_data, plugin_handler.unmatched_candidates([subscription_data]))
+        plugin_handler.plugin_subscriptions.remove(subscription_data)
+        plugin_handler.plugins_by_name.pop("test_unmatched")
+        plugin_handler.unmatched_plugins.remove(subscription_data)
+        plugin_handler.trigger_index["first_words"]["please"].remove(subscription_data)
+
+class check_runner_tests(unittest.TestCase):
+    def test_deadline(self):
+        runner = check_runner.CheckRunner(worker_num=2, timeout=0.05, demote_after=2)
+        fast = {"name": "fast", "check": lambda event: True}
+        slow = {"name": "slow", "check": lambda event: time.sleep(0.2) or True}
+        run_check = lambda plugin: plugin["check"](None)
+        self.assertEqual(runner.run([fast, slow], run_check), [fast])
+        self.assertFalse(runner.is_demoted("slow"))
+        self.assertEqual(runner.run([fast, slow], run_check), [fast])
+        self.assertTrue(runner.is_demoted("slow"))
+        self.assertEqual(runner.run([slow], run_check), [])
+
+class breaker_tests(unittest.TestCase):
+    def test_trip_and_reset(self):
+        plugin_breaker = breaker.CircuitBreaker("test", failure_threshold=2, reset_seconds=0.05)
+        plugin_breaker.record_failure("error")
+        self.assertTrue(plugin_breaker.allow())
+        plugin_breaker.record_failure("error")
+        self.assertFalse(plugin_breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(plugin_breaker.allow())
+        self.assertFalse(plugin_breaker.allow())
+        plugin_breaker.record_success()
+        self.assertEqual(plugin_breaker.state, breaker.closed)
+    def test_late_outcome(self):
+        plugin_breaker = breaker.CircuitBreaker("test", failure_threshold=1, reset_seconds=60)
+        timed_out_call = plugin_breaker.start_call()
+        plugin_breaker.record_failure("Timed out", timed_out_call)
+        #The call finishing after its timeout neither closes the breaker nor counts again
+        plugin_breaker.record_success(timed_out_call)
+        plugin_breaker.record_failure("error", timed_out_call)
+        self.assertEqual((plugin_breaker.state, plugin_breaker.failures), (breaker.open_state, 1))
+
+class lanes_tests(unittest.TestCase):
+    def test_fair_admission(self):
+        fair_queue = lanes.FairQueue("test", queue_depth=4, user_depth=3)
+        for item in ("a1", "a2", "a3"):
+            fair_queue.put("alice", item)
+        self.assertRaises(lanes.Queue.Full, fair_queue.put, "alice", "a4")
+        fair_queue.put("bob", "b1")
+        self.assertRaises(lanes.Queue.Full, fair_queue.put, "carol", "c1")
+        self.assertEqual([fair_queue.get() for i in range(4)], ["a1", "b1", "a2", "a3"])
+
+class response_cache_tests(unittest.TestCase):
+    def test_ttl_and_eviction(self):
+        cache = response_cache.ResponseCache()
+        cache.put("search", "a", {"text": "a"}, ttl=60, max_entries=2)
+        cache.put("search", "b", {"text": "b"}, ttl=60, max_entries=2)
+        self.assertEqual(cache.get("search", "a"), {"text": "a"})
+        cache.put("search", "c", {"text": "c"}, ttl=60, max_entries=2)
+        self.assertIsNone(cache.get("search", "b"))
+        cache.put("weather", "a", {"text": "sunny"}, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("weather", "a"))
+        search_stats = cache.stats()[0]
+        self.assertEqual((search_stats["hit"], search_stats["miss"], search_stats["entries"]), (1, 1, 2))
+
+class coalesce_tests(unittest.TestCase):
+    def setUp(self):
+        self.module_state = (plugin_handler.plugin_lanes, plugin_handler.breakers, plugin_handler.plugin_timeout)
+        plugin_handler.start_lanes(failure_threshold=1)
+        self.plugin_subscriptions = plugin_handler.subscriptions()
+    def tearDown(self):
+        plugin_handler.plugin_lanes, plugin_handler.breakers, plugin_handler.plugin_timeout = self.module_state
+    def submit(self, plugin, usernames):
+        return [self.plugin_subscriptions.submit_plugin(plugin, {
+            "command": "same", "username": username, "user_table": {"admin": False, "default_plugin": "search"}
+        }) for username in usernames]
+    def test_shared_call(self):
+        calls = []
+        def slow_plugin(event):
+            calls.append(event["username"])
+            time.sleep(0.05)
+            return {"type": "success", "text": "Shared", "data": {}}
+        plugin = {"name": "coalesce_test", "function": slow_plugin, "lane": "slow",
+                  "coalesce": lambda event: event["command"]}
+        tasks = self.submit(plugin, ("alice", "bob", "carol"))
+        self.assertEqual([task.result(1)["text"] for task in tasks], ["Shared"]*3)
+        self.assertEqual(calls, ["alice"])
+        self.assertEqual(plugin_handler.in_flight, {})
+    def test_open_breaker(self):
+        plugin = {"name": "coalesce_broken", "function": lambda event: {"type": "success", "text": "Ran", "data": {}},
+                  "fallback": lambda event: {"type": "success", "text": "Fallback", "data": {}},
+                  "coalesce": lambda event: event["command"]}
+        plugin_handler.breakers.get("coalesce_broken").record_failure("error")
+        tasks = self.submit(plugin, ("alice", "bob"))
+        self.assertEqual([task.result(1)["text"] for task in tasks], ["Fallback"]*2)
+        self.assertEqual(plugin_handler.in_flight, {})
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,12 +5,9 @@ import core
 import uuid
 import time
 import base64
-try:
-    import queue as Queue
-except ImportError:
-    import Queue
 import datetime
 import string
+import collections
 
 valid_chars = set(string.ascii_letters+string.digits+'{}|~^<>!#$%()+,-.@_[] ')
 
@@ -18,6 +15,8 @@ log = logging.getLogger()
 
 log.debug("Valid SQL characters are {0}".format(valid_chars))
 
+db_seconds = core.metrics.histogram("will_db_seconds", "Time spent in db queries", ["operation"])
+
 session_nums = 0
 
 command_nums = {}
@@ -39,12 +38,21 @@ def set_response(session_id, command_id, event, response_function):
     """
     session_container = core.sessions[session_id]
     commands_container = session_container["commands"]
-    for command in commands_container:
+    command_data = None
+    #Iterate over a copy, commands are appended to the history from other threads
+    for command in list(commands_container):
         if command["id"] == command_id:
             command_data = command
+    if not command_data:
+        log.warning(":{0}:Command {1} is no longer in the session history, not setting response".format(
+            session_id, command_id
+        ))
+        return
+    response_ttl = core.configuration_data.get("response_ttl", core.session_registry.default_response_ttl)
     command_data.update({
         "event": event,
-        "function": response_function
+        "function": response_function,
+        "response_expires": time.time()+response_ttl
     })
 
 
@@ -57,15 +65,18 @@ def gen_session(username, client_type, db):
     session_id = get_session_id(db)
     # Start monitoring notifications
     # Register a session id
-    core.sessions.update({
-        session_id: {
-            "username": username,
-            "commands": [],
-            "created": datetime.datetime.now(),
-            "updates": Queue.Queue(),
-            "id": session_id,
-            "client": client_type
-        }
+    history_size = core.configuration_data.get("session_history", core.session_registry.default_history)
+    core.sessions.add({
+        "username": username,
+        "commands": collections.deque(maxlen=history_size),
+        "created": datetime.datetime.now(),
+        "last_active": time.time(),
+        "updates": core.updates.UpdateBuffer(
+            size=core.configuration_data.get("update_buffer_size", core.updates.default_buffer_size),
+            policy=core.configuration_data.get("update_buffer_policy", core.updates.default_policy)
+        ),
+        "id": session_id,
+        "client": client_type
     })
     return session_id
 
@@ -128,13 +139,14 @@ def load_key(key_type, db, load_url=False):
     :param load_url:
     :return api key:
     """
-    working_keys = db.query('SELECT * FROM `keys` WHERE type="{0}" and uses <= max_uses'.format(key_type))
-    correct_key = sorted(working_keys, key=lambda x: x["num"])[0]
-    key_uses = correct_key["uses"]
-    key_value = correct_key["value"]
-    updated_uses = key_uses+1
-    #Assume that keys reset monthly
-    db['keys'].update(dict(type=key_type, num=correct_key['num'], uses=updated_uses), ['type', 'num'])
+    with db_seconds.time(operation="load_key"):
+        working_keys = db.query('SELECT * FROM `keys` WHERE type="{0}" and uses <= max_uses'.format(key_type))
+        correct_key = sorted(working_keys, key=lambda x: x["num"])[0]
+        key_uses = correct_key["uses"]
+        key_value = correct_key["value"]
+        updated_uses = key_uses+1
+        #Assume that keys reset monthly
+        db['keys'].update(dict(type=key_type, num=correct_key['num'], uses=updated_uses), ['type', 'num'])
     if load_url:
         return (key_value, correct_key["url"])
     return key_value
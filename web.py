@@ -3,8 +3,6 @@ import core
 from flask import Blueprint, render_template, redirect, request, session, make_response, Response, stream_with_context
 import bcrypt
 import logging
-import threading
-import time
 import tools
 import requests
 
@@ -27,36 +25,14 @@ def signup():
     return render_template("signup.html")
 
 
-def update_loop(session_id, sid):
-    """
-    :param session_id: W.I.L.L session id
-    :param sid: Flask session id
-    Update thread that will emit socket.io updates to the user while they're connected
-
-    :return:
-    """
-    while session_id in core.sessions.keys():
-        try:
-            session_data = core.sessions[session_id]
-        except KeyError:
-            #Session ended while loop was sleeping
-            break
-        session_updates = session_data["updates"]
-        while not session_updates.empty():
-            update = session_updates.get()
-            log.debug("Pushing update {0}".format(update))
-            socketio.emit('update', update, room=sid)
-        time.sleep(1)
-    log.info(":{0}:Ending updates for finished session".format(session_id))
-
-
 def disconnect_session():
     """
     :param session_id:
-    End the webapp session and the update thread on the users disconnect from the page
+    End the webapp session and stop pushing updates on the users disconnect from the page
     :return:
     """
     log.info(":SOCKET:disconnect")
+    core.update_pusher.unsubscribe(request.sid)
     session_id = session["session_id"]
     if session_id in core.sessions.keys():
         log.info(":{0}:Session disconnected".format(session_id))
@@ -81,8 +57,9 @@ def settings_page():
 
 def get_updates(data):
     """
-    :param data: socket.io data about the update thread:
-    Authenticate and start the update thread
+    :param data: socket.io data about the update subscription. Can include last_seq, the sequence number of
+    the last update the client received, to resume from there
+    Authenticate and subscribe the client to the sessions updates
     :return:
     """
     log.info(":SOCKET:get_updates")
@@ -93,16 +70,30 @@ def get_updates(data):
             log.debug("{1}:Subscribing client {0} to updates for session_id".format(
                 request.environ["REMOTE_ADDR"], session_id
             ))
-            #Keep running this loop while the session is active
-            log.info(":{0}:Starting update loop".format(session_id))
-            update_thread = threading.Thread(target=update_loop, args=(session_id, request.sid))
-            update_thread.start()
+            core.sessions.touch(session_id)
+            log.info(":{0}:Subscribing to updates".format(session_id))
+            last_seq = data.get("last_seq")
+            #Anything but a sequence number replays every unacknowledged update
+            if not isinstance(last_seq, int):
+                last_seq = None
+            core.update_pusher.subscribe(session_id, request.sid, last_seq=last_seq)
         else:
             log.debug("Session id {0} is invalid".format(session_id))
             socketio.emit("update", {"value": "Error, invalid session id"})
     else:
         socketio.emit("update", {"value": "Error, couldn't find session id in update request"})
 
+def ack_updates(data):
+    """
+    :param data: socket.io data with the session_id and seq, the sequence number of the last update received
+    Let the session drop updates the client has received
+    :return:
+    """
+    session_id = data.get("session_id")
+    seq = data.get("seq")
+    if session_id in core.sessions.keys() and isinstance(seq, int):
+        core.update_pusher.ack(session_id, seq)
+
 @web.route("/login", methods=["POST"])
 def login():
     """
@@ -211,24 +202,43 @@ def report(path):
         if user_table:
             if user_table["admin"]:
                 #Get the session_data
-                session["commands-processed"] = core.processed_commands
+                session["errors"] = core.commands_processed.value(result="error")
+                session["success"] = core.commands_processed.value(result="success")
+                session["commands-processed"] = session["errors"]+session["success"]
                 time_str = start_time
                 session["start-time"] = start_time
-                users_online = 0
-                users_processed = []
-                for session_id in core.sessions:
-                    session_data = core.sessions[session_id]
-                    session_user = session_data["username"]
-                    if session_user not in users_processed:
-                        users_processed.append(str(session_user))
-                        users_online+=1
-                session["users-online"] = users_online
-                session["active-sessions"] = len(core.sessions)
-                session["errors"] = core.error_num
-                session["success"] = core.success_num
+                users_processed = [str(session_user) for session_user in core.sessions.users()]
+                session["users-online"] = core.sessions.user_count()
+                session["active-sessions"] = core.sessions.session_count()
                 session["users-list"] = users_processed
                 if path == "report":
-                    return render_template('report.html')
+                    checks = core.plugin_handler.checks
+                    return render_template(
+                        'report.html',
+                        breakers=core.plugin_handler.breakers.states(),
+                        demoted_checks=checks.demoted() if checks else {},
+                        lanes=core.plugin_handler.lane_states()
+                    )
+                elif path == "metrics":
+                    return Response(core.metrics.registry.render(), content_type="text/plain; version=0.0.4")
+                elif path == "plugins":
+                    checks = core.plugin_handler.checks
+                    return tools.return_json({
+                        "type": "success",
+                        "text": "Plugin lanes, circuit breakers, response caches and demoted check functions",
+                        "data": {
+                            "lanes": core.plugin_handler.lane_states(),
+                            "response_cache": core.plugin_handler.responses.stats(),
+                            "breakers": core.plugin_handler.breakers.states(),
+                            "demoted_checks": checks.demoted() if checks else {}
+                        }
+                    })
+                elif path == "traces":
+                    return tools.return_json({
+                        "type": "success",
+                        "text": "Recent command traces",
+                        "data": {"traces": core.tracing.traces.recent()}
+                    })
                 elif path == "logging":
                     if "log_proxy" in configuration_data.keys():
                         req = requests.get(configuration_data["log_proxy"], stream=True)
@@ -25,22 +25,20 @@ import web
 class will:
 
     @atexit.register
-    def dump_events(self, *args):
+    def dump_events(self=None, *args):
         '''
-        Dump events to db on exit
+        Commit the event journal on exit. Pending events are already in the journal or the db
         :return:
         '''
         try:
-            log.info(":SYS:Dumping events")
+            log.info(":SYS:Committing event journal")
         except:
-            print(":SYS: Error with logging while dumping events")
-        for event in core.events:
-            if event["type"] != "function":
-                try:
-                    log.debug(":SYS:Dumping event {0}".format(event))
-                    db["events"].upsert(event, ['uid'])
-                except:
-                    print(":SYS:Error encountered while dumping events")
+            print(":SYS: Error with logging while committing event journal")
+        if core.journal:
+            try:
+                core.journal.close()
+            except:
+                print(":SYS:Error encountered while committing event journal")
 
     def start(self):
         """
@@ -77,6 +75,7 @@ class will:
             self.configuration_data = json_data
             API.configuration_data = self.configuration_data
             web.configuration_data = self.configuration_data
+            core.configuration_data = self.configuration_data
         else:
             print("Couldn't find will.conf file, exiting")
             os._exit(1)
@@ -104,9 +103,11 @@ class will:
         self.socketio = SocketIO(app)
 
         web.socketio = self.socketio
+        core.update_pusher.emit_function = self.socketio.emit
 
         self.socketio.on(web.disconnect_session, 'disconnect')
         self.socketio.on(web.get_updates, "get_updates")
+        self.socketio.on(web.ack_updates, "ack_updates")
 
         signal.signal(signal.SIGTERM, self.dump_events)
 